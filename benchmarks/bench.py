@@ -0,0 +1,279 @@
+"""Нагрузочный тест бота без сети: Open-Meteo и Bot API заменены локальными заглушками.
+
+    python -m benchmarks.bench updates --users 2000 --updates 20000
+    python -m benchmarks.bench broadcast --subscribers 10000 --cities 300
+
+Запускать из корня репозитория.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+from datetime import datetime, timedelta
+
+# config.py с токеном в репозитории не хранится — для теста он не нужен
+try:
+    import config  # noqa: F401
+except ImportError:
+    sys.modules["config"] = types.SimpleNamespace(TOKEN="123456:benchmark")
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import database
+import forecast_api
+import geocoding
+import http_client
+from benchmarks.stubs import StubConfig, start_stub_server
+from callbacks import CityAction
+from metrics import THROTTLED
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def city_names(count: int) -> list[str]:
+    return [f"Город-{i}" for i in range(count)]
+
+
+class Environment:
+    """Заглушки, временная база и бот, направленный на заглушку Bot API."""
+
+    def __init__(self, args):
+        self.args = args
+        self.stub_config = StubConfig(args.latency / 1000, args.jitter / 1000, args.error_rate)
+
+    async def __aenter__(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.DB_NAME = os.path.join(self.tmpdir.name, "bench.db")
+        database.init_db()
+
+        self.runner, base_url = await start_stub_server(self.stub_config)
+        geocoding.GEOCODING_URL = f"{base_url}/v1/search"
+        forecast_api.FORECAST_URL = f"{base_url}/v1/forecast"
+
+        session = AiohttpSession(api=TelegramAPIServer.from_base(base_url))
+        self.bot = Bot(
+            token="123456:benchmark",
+            session=session,
+            default=DefaultBotProperties(parse_mode="Markdown"),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.bot.session.close()
+        await http_client.close_session()
+        await self.runner.cleanup()
+        database.close_db()
+        self.tmpdir.cleanup()
+
+
+# ------------------------------------------------------------
+# Поток апдейтов от пользователей
+# ------------------------------------------------------------
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def _chat(user_id: int) -> dict:
+    return {"id": user_id, "type": "private"}
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": _chat(user_id),
+            "from": _user(user_id),
+            "text": text,
+        },
+    }
+
+
+def callback_update(update_id: int, user_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "chat_instance": str(user_id),
+            "from": _user(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": _chat(user_id),
+                "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+# доли видов апдейтов в синтетическом потоке
+UPDATE_MIX = (
+    ("today", 30),
+    ("show_weather", 20),
+    ("tomorrow", 15),
+    ("city_input", 10),
+    ("start", 8),
+    ("choose_city", 7),
+    ("select_city", 5),
+    ("subscription", 5),
+)
+
+
+def generate_updates(count: int, users: int, cities: list[str], city_ids: dict[str, int]):
+    kinds = [kind for kind, _ in UPDATE_MIX]
+    weights = [weight for _, weight in UPDATE_MIX]
+
+    for update_id in range(1, count + 1):
+        user_id = random.randint(1, users)
+        kind = random.choices(kinds, weights)[0]
+
+        if kind == "city_input":
+            yield message_update(update_id, user_id, random.choice(cities))
+        elif kind == "start":
+            yield message_update(update_id, user_id, "/start")
+        elif kind == "select_city":
+            city_id = city_ids[random.choice(cities)]
+            yield callback_update(update_id, user_id, CityAction(action="select", city_id=city_id).pack())
+        else:
+            yield callback_update(update_id, user_id, kind)
+
+
+async def seed_users(users: int, cities: list[str]) -> dict[str, int]:
+    for user_id in range(1, users + 1):
+        city = cities[user_id % len(cities)]
+        await database.save_default_city(user_id, city)
+        await database.add_city(user_id, city)
+
+    return {city: await database.register_city(city) for city in cities}
+
+
+async def bench_updates(args):
+    from bot import create_dispatcher
+
+    async with Environment(args) as env:
+        cities = city_names(args.cities)
+        city_ids = await seed_users(args.users, cities)
+        # синтетические пользователи шлют апдейты чаще живых — защита от флуда
+        # отклоняла бы большую часть, и замер был бы не обработки, а отказов
+        dp = create_dispatcher(throttling=args.throttling)
+
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def process(update):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await dp.feed_raw_update(env.bot, update)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            process(update)
+            for update in generate_updates(args.updates, args.users, cities, city_ids)
+        ))
+        elapsed = time.perf_counter() - started
+
+    print(f"апдейтов:        {args.updates} ({args.users} пользователей, {args.cities} городов)")
+    print(f"ошибок:          {errors}")
+    if args.throttling:
+        print(f"отклонено:       {sum(THROTTLED._values.values()):.0f} (защита от флуда)")
+    print(f"апдейтов/с:      {args.updates / elapsed:.1f}")
+    print(f"p50 обработки:   {percentile(latencies, 50) * 1000:.1f} мс")
+    print(f"p99 обработки:   {percentile(latencies, 99) * 1000:.1f} мс")
+    print(f"запросов к заглушкам: {env.stub_config.requests}")
+
+
+# ------------------------------------------------------------
+# Ежедневная рассылка
+# ------------------------------------------------------------
+
+async def bench_broadcast(args):
+    from scheduler import broadcast, prefetch
+    from sender import MessageSender
+
+    async with Environment(args) as env:
+        cities = city_names(args.cities)
+        slot = datetime.now().replace(second=0, microsecond=0)
+        time_str = slot.strftime("%H:%M")
+
+        for user_id in range(1, args.subscribers + 1):
+            await database.save_default_city(user_id, cities[user_id % len(cities)])
+            await database.set_sub_time(user_id, time_str)
+
+        sender = MessageSender(env.bot, workers=args.workers, rate=args.rate)
+        sender.start()
+
+        prefetch_time = 0.0
+        if args.prefetch:
+            started = time.perf_counter()
+            await prefetch(slot - timedelta(minutes=1), use_index=False)
+            prefetch_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await broadcast(sender, slot)
+        elapsed = time.perf_counter() - started
+        await sender.stop()
+
+    print(f"подписчиков:     {args.subscribers} ({args.cities} городов)")
+    if args.prefetch:
+        print(f"предзагрузка:    {prefetch_time:.2f} с")
+    print(f"рассылка:        {elapsed:.2f} с ({args.subscribers / elapsed:.1f} сообщений/с)")
+    print(f"запросов к заглушкам: {env.stub_config.requests}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальными заглушками")
+    parser.add_argument("--latency", type=float, default=20, help="задержка заглушек, мс")
+    parser.add_argument("--jitter", type=float, default=10, help="разброс задержки, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--seed", type=int, default=1)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    # общие для обоих режимов параметры данных — указываются после режима
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--cities", type=int, default=100, help="число разных городов")
+
+    updates = commands.add_parser("updates", parents=[common], help="поток апдейтов от пользователей")
+    updates.add_argument("--users", type=int, default=1000)
+    updates.add_argument("--updates", type=int, default=10000)
+    updates.add_argument("--concurrency", type=int, default=100, help="апдейтов в обработке одновременно")
+    updates.add_argument("--throttling", action="store_true", help="включить защиту от флуда")
+
+    broadcast = commands.add_parser("broadcast", parents=[common], help="ежедневная рассылка")
+    broadcast.add_argument("--subscribers", type=int, default=5000)
+    broadcast.add_argument("--workers", type=int, default=8, help="воркеры очереди отправки")
+    broadcast.add_argument("--rate", type=float, default=1000, help="лимит сообщений в секунду")
+    broadcast.add_argument("--prefetch", action="store_true", help="сначала прогреть кэш прогнозов")
+
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    if args.command == "updates":
+        asyncio.run(bench_updates(args))
+    else:
+        asyncio.run(bench_broadcast(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Локальные заглушки Open-Meteo и Bot API для нагрузочных тестов."""
+import asyncio
+import hashlib
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+
+from aiohttp import web
+
+
+class StubConfig:
+    """Задержка ответа (секунды, ± jitter) и доля ответов с ошибкой 500."""
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.01, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = {"geocoding": 0, "forecast": 0, "bot_api": 0}
+
+
+def _coords_of(name: str):
+    digest = hashlib.md5(name.lower().encode()).digest()
+    return 40 + digest[0] / 8, 20 + digest[1] / 4
+
+
+def _forecast_for(lat: float, lon: float) -> dict:
+    start = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    hours = [start + timedelta(hours=h) for h in range(72)]
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "current_weather": {"temperature": 12.3, "windspeed": 4.5, "weathercode": 2},
+        "hourly": {
+            "time": [h.strftime("%Y-%m-%dT%H:%M") for h in hours],
+            "temperature_2m": [round(5 + (h.hour % 24) / 2, 1) for h in hours],
+            "weathercode": [(0, 1, 2, 3, 61)[h.hour % 5] for h in hours],
+        },
+    }
+
+
+def create_stub_app(config: StubConfig) -> web.Application:
+    message_ids = itertools.count(1)
+
+    async def delay(kind: str):
+        config.requests[kind] += 1
+        await asyncio.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+        if random.random() < config.error_rate:
+            raise web.HTTPInternalServerError()
+
+    async def geocoding(request: web.Request):
+        await delay("geocoding")
+        name = request.query.get("name", "")
+        # названия с «zz» считаем несуществующими
+        if not name or "zz" in name.lower():
+            return web.json_response({"generationtime_ms": 0.1})
+
+        lat, lon = _coords_of(name)
+        return web.json_response({"results": [{"name": name, "latitude": lat, "longitude": lon}]})
+
+    async def forecast(request: web.Request):
+        await delay("forecast")
+        lats = [float(x) for x in request.query["latitude"].split(",")]
+        lons = [float(x) for x in request.query["longitude"].split(",")]
+
+        results = [_forecast_for(lat, lon) for lat, lon in zip(lats, lons)]
+        return web.json_response(results if len(results) > 1 else results[0])
+
+    async def bot_api(request: web.Request):
+        await delay("bot_api")
+        method = request.match_info["method"].lower()
+        data = await request.post()
+
+        if method in ("sendmessage", "editmessagetext"):
+            result = {
+                "message_id": next(message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 1) or 1), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app.router.add_get("/v1/search", geocoding)
+    app.router.add_get("/v1/forecast", forecast)
+    app.router.add_post("/bot{token}/{method}", bot_api)
+    return app
+
+
+async def start_stub_server(config: StubConfig, host: str = "127.0.0.1", port: int = 0):
+    """Запускает заглушки; возвращает (runner, базовый URL)."""
+    runner = web.AppRunner(create_stub_app(config))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}"
@@ -1,49 +1,153 @@
 import asyncio
-from datetime import datetime
-from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove
+import logging
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.types import Message, CallbackQuery, ReplyKeyboardRemove, ErrorEvent
+from aiogram.filters import ExceptionTypeFilter
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest
 
+import config
 from config import TOKEN
+from cache import TTLCache, MISSING
 from database import (
-    init_db, get_default_city, save_default_city,
+    init_db, close_db, set_profile_cache_ttl, get_default_city, save_default_city,
     add_city, get_cities, set_sub_time,
-    get_sub_time, delete_sub, get_all_subscriptions
+    get_sub_time, delete_sub, unmark_blocked,
+    register_city, get_city_name
 )
 from weather_api import get_weather
-from inline_keyboards import main_menu, city_choice_menu, new_city_actions, subscription_menu
+from http_client import close_session, UpstreamError
+from metrics import MetricsMiddleware, start_metrics_server
+from throttling import ThrottlingMiddleware
+from tracing import TracingMiddleware, TracingRequestMiddleware, SLOW_UPDATE
+from scheduler import scheduler, subscriptions
+from webhook import webhook_enabled, run_webhook
+from callbacks import CityAction, CitySuggestion
+from inline_keyboards import (
+    main_menu, city_choice_menu, city_suggestions_menu, new_city_actions, subscription_menu, back_menu
+)
 from reply_keyboards import bottom_menu
 from forecast_api import get_today_text, get_tomorrow_text
+from geocoding import get_coords
+from city_index import get_city_index
+
+# False — рассылкой занимаются отдельные процессы worker.py
+RUN_SCHEDULER = getattr(config, "RUN_SCHEDULER", True)
+
+# Локальный эндпоинт /metrics для Prometheus (None — выключен)
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9090)
+
+# Время жизни кэша профилей в секундах (None — по умолчанию, час). У нескольких
+# экземпляров за балансировщиком изменения с одного видны другим только
+# после истечения кэша — для них задайте несколько секунд или 0
+PROFILE_CACHE_TTL = getattr(config, "PROFILE_CACHE_TTL", None)
+
+# Защита от флуда: лимиты на пользователя и на одновременные запросы к Open-Meteo
+THROTTLING = getattr(config, "THROTTLING", True)
+
+# Трассировка апдейтов JSON-строками в лог; апдейты дольше SLOW_UPDATE секунд —
+# со стеком, а при заданном PROFILE_DIR доля PROFILE_SAMPLE — с профилем cProfile
+TRACING = getattr(config, "TRACING", False)
+SLOW_UPDATE = getattr(config, "SLOW_UPDATE", SLOW_UPDATE)
+PROFILE_DIR = getattr(config, "PROFILE_DIR", None)
+PROFILE_SAMPLE = getattr(config, "PROFILE_SAMPLE", 0.01)
+
+# True — ответ на кнопку редактирует сообщение с меню вместо отправки двух новых
+EDIT_IN_PLACE = getattr(config, "EDIT_IN_PLACE", True)
+
+UNAVAILABLE_TEXT = "⚠️ Сервис погоды временно недоступен, попробуйте позже."
+
+# Название, которого нет в справочнике, ждёт проверки геокодером в памяти,
+# а в реестр городов попадает только после неё
+PENDING_CITY_TTL = 600
+_pending_cities = TTLCache(maxsize=100_000, ttl=PENDING_CITY_TTL)
+
+
+class AnswerCallbackMiddleware(BaseMiddleware):
+    """Отвечает на нажатие кнопки до обработчика — «часики» пропадают сразу,
+    а не после запросов к базе и Open-Meteo. Поэтому обработчики сообщают
+    об ошибках сообщением, а не всплывающим уведомлением."""
+
+    async def __call__(self, handler, event: CallbackQuery, data):
+        try:
+            await event.answer()
+        except TelegramBadRequest:
+            # запрос устарел — результат всё равно покажем в сообщении
+            pass
+        return await handler(event, data)
+
+
+async def city_from_callback(callback: CallbackQuery, callback_data: CityAction):
+    """Название города по id из callback_data."""
+    city = await get_city_name(callback_data.city_id)
+    if city is None:
+        await respond(callback, "❌ Город не найден, введите его заново.", reply_markup=back_menu())
+    return city
+
+
+async def respond(callback: CallbackQuery, text: str, menu_text: str | None = None, reply_markup=None):
+    """Ответ на нажатие inline-кнопки.
+
+    В режиме EDIT_IN_PLACE результат и меню объединяются в одно сообщение,
+    которым заменяется сообщение с нажатой кнопкой. Иначе, как раньше, —
+    результат и меню отдельными сообщениями. На само нажатие уже ответил
+    AnswerCallbackMiddleware.
+    """
+    if not EDIT_IN_PLACE:
+        if menu_text is None:
+            await callback.message.answer(text, reply_markup=reply_markup)
+        else:
+            await callback.message.answer(text)
+            await callback.message.answer(menu_text, reply_markup=reply_markup)
+        return
+
+    if menu_text is not None:
+        text = f"{text}\n\n{menu_text}"
+
+    try:
+        await callback.message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        # повторное нажатие той же кнопки — сообщение уже такое
+        if "message is not modified" in e.message:
+            return
+        # сообщение нельзя изменить (слишком старое и т.п.) — шлём новое
+        await callback.message.answer(text, reply_markup=reply_markup)
 
 
-async def scheduler(bot: Bot):
-    """Ежедневная рассылка погоды"""
-    while True:
-        now = datetime.now().strftime("%H:%M")
+def create_dispatcher(throttling: bool | None = None) -> Dispatcher:
+    """Диспетчер со всеми обработчиками — общий для polling и webhook.
 
-        for user_id, t in get_all_subscriptions():
-            if t == now:
-                city = get_default_city(user_id)
-                if city:
-                    forecast = get_today_text(city)
-                    try:
-                        await bot.send_message(user_id, f"📨 Ежедневная рассылка:\n\n{forecast}")
-                    except:
-                        pass
+    throttling — включить защиту от флуда (None — по настройке THROTTLING).
+    """
+    dp = Dispatcher()
 
-        await asyncio.sleep(60)
+    if TRACING:
+        dp.update.outer_middleware(TracingMiddleware(SLOW_UPDATE, PROFILE_DIR, PROFILE_SAMPLE))
 
+    # отклонённые апдейты не доходят до обработчиков и их метрик
+    if THROTTLING if throttling is None else throttling:
+        limiter = ThrottlingMiddleware()
+        dp.message.middleware(limiter)
+        dp.callback_query.middleware(limiter)
 
-async def main():
-    init_db()
+    # время каждого обработчика — в метрики
+    dp.message.middleware(MetricsMiddleware())
+    dp.callback_query.middleware(MetricsMiddleware())
 
-    bot = Bot(
-        token=TOKEN,
-        default=DefaultBotProperties(parse_mode="Markdown")
-    )
-    dp = Dispatcher()
+    # отклонённые нажатия защита от флуда закрывает сама, остальные — здесь
+    dp.callback_query.middleware(AnswerCallbackMiddleware())
 
-    asyncio.create_task(scheduler(bot))
+    # ============================================================
+    # Open-Meteo недоступен и в кэше ничего нет
+    # ============================================================
+    @dp.errors(ExceptionTypeFilter(UpstreamError))
+    async def upstream_unavailable(event: ErrorEvent):
+        # на нажатие уже ответили — сообщаем отдельным сообщением, меню остаётся
+        update = event.update
+        message = update.callback_query.message if update.callback_query else update.message
+        if message is not None:
+            await message.answer(UNAVAILABLE_TEXT)
 
     # ============================================================
     # /start
@@ -51,7 +155,8 @@ async def main():
     @dp.message(F.text == "/start")
     async def start_cmd(message: Message):
         user_id = message.from_user.id
-        city = get_default_city(user_id)
+        await unmark_blocked(user_id)
+        city = await get_default_city(user_id)
 
         await message.answer("⏳ Загрузка меню...", reply_markup=bottom_menu())
 
@@ -70,7 +175,7 @@ async def main():
     @dp.message(F.text == "🏠 Меню")
     async def bottom_menu_button(message: Message):
         user_id = message.from_user.id
-        city = get_default_city(user_id)
+        city = await get_default_city(user_id)
 
         if not city:
             await message.answer("Введите ваш город:")
@@ -99,132 +204,185 @@ async def main():
             return
 
         time_str = f"{hh:02d}:{mm:02d}"
-        set_sub_time(user_id, time_str)
+        await set_sub_time(user_id, time_str)
+        subscriptions.set(user_id, time_str)
 
         await message.answer(
             f"✅ Ежедневная рассылка установлена на *{time_str}*."
         )
 
-    @dp.message(F.text)
+    @dp.message(F.text, flags={"heavy": True})
     async def process_city_input(message: Message):
         """Обработка ввода города текстом"""
-        user_id = message.from_user.id
         city = message.text.strip()
+        index = get_city_index()
 
-        weather = get_weather(city)
-        if weather is None:
-            await message.answer("❌ Город не найден, попробуйте снова.")
-            return
+        # известный город — сразу, без запроса к геокодеру
+        known = index.lookup(city)
+        if known is not None:
+            city = known.name
+        else:
+            suggestions = index.suggest(city)
+            if suggestions:
+                _pending_cities.set(message.from_user.id, city)
+                choices = [(c.number, c.name) for c in suggestions]
+                # введённый текст ещё не проверен и может сломать разметку —
+                # показываем его только на кнопке, где разметки нет
+                await message.answer(
+                    "🤔 Такого города нет в справочнике. Возможно, вы имели в виду:",
+                    reply_markup=city_suggestions_menu(choices, city)
+                )
+                return
+
+            lat, lon = await get_coords(city)
+            if lat is None:
+                await message.answer("❌ Город не найден, попробуйте снова.")
+                return
+
+        city_id = await register_city(city)
 
         await message.answer(
             f"Город *{city}* найден.\nВыберите действие:",
-            reply_markup=new_city_actions(city)
+            reply_markup=new_city_actions(city_id)
         )
 
     # ============================================================
     # CALLBACK-и (inline)
     # ============================================================
 
-    @dp.callback_query(F.data == "show_weather")
+    @dp.callback_query(F.data == "show_weather", flags={"heavy": True})
     async def show_weather(callback: CallbackQuery):
         user_id = callback.from_user.id
-        city = get_default_city(user_id)
-        text = get_weather(city)
+        city = await get_default_city(user_id)
+        text = await get_weather(city)
 
-        await callback.message.answer(text)
-        await callback.message.answer(
-            f"🌆 Ваш основной город: *{city}*",
-            reply_markup=main_menu(city)
-        )
+        await respond(callback, text, f"🌆 Ваш основной город: *{city}*", main_menu(city))
 
-    @dp.callback_query(F.data == "today")
+    @dp.callback_query(F.data == "today", flags={"heavy": True})
     async def today_forecast(callback: CallbackQuery):
         user_id = callback.from_user.id
-        city = get_default_city(user_id)
-        text = get_today_text(city)
+        city = await get_default_city(user_id)
+        text = await get_today_text(city)
 
-        await callback.message.answer(text)
-        await callback.message.answer(
-            f"🌆 Ваш основной город: *{city}*",
-            reply_markup=main_menu(city)
-        )
+        await respond(callback, text, f"🌆 Ваш основной город: *{city}*", main_menu(city))
 
-    @dp.callback_query(F.data == "tomorrow")
+    @dp.callback_query(F.data == "tomorrow", flags={"heavy": True})
     async def tomorrow_forecast(callback: CallbackQuery):
         user_id = callback.from_user.id
-        city = get_default_city(user_id)
-        text = get_tomorrow_text(city)
+        city = await get_default_city(user_id)
+        text = await get_tomorrow_text(city)
 
-        await callback.message.answer(text)
-        await callback.message.answer(
-            f"🌆 Ваш основной город: *{city}*",
-            reply_markup=main_menu(city)
-        )
+        await respond(callback, text, f"🌆 Ваш основной город: *{city}*", main_menu(city))
 
     @dp.callback_query(F.data == "choose_city")
     async def choose_city(callback: CallbackQuery):
         user_id = callback.from_user.id
-        cities = get_cities(user_id)
+        cities = await get_cities(user_id)
 
         if not cities:
-            await callback.message.answer("У вас нет сохранённых городов.")
+            await respond(callback, "У вас нет сохранённых городов.", reply_markup=back_menu())
+            return
+
+        cities = [(await register_city(city), city) for city in cities]
+
+        await respond(callback, "Ваши города:", reply_markup=city_choice_menu(cities))
+
+    @dp.callback_query(CityAction.filter(F.action == "select"), flags={"heavy": True})
+    async def selected_city(callback: CallbackQuery, callback_data: CityAction):
+        city = await city_from_callback(callback, callback_data)
+        if city is None:
             return
 
-        await callback.message.answer(
-            "Ваши города:",
-            reply_markup=city_choice_menu(cities)
+        weather = await get_weather(city)
+
+        await respond(callback, weather, "Выберите действие:", new_city_actions(callback_data.city_id))
+
+    @dp.callback_query(CitySuggestion.filter())
+    async def pick_city(callback: CallbackQuery, callback_data: CitySuggestion):
+        """Выбран вариант из справочника — проверять геокодером не нужно."""
+        cities = get_city_index().cities
+        if not 0 <= callback_data.number < len(cities):
+            await respond(callback, "❌ Город не найден, введите его заново.", reply_markup=back_menu())
+            return
+
+        city = cities[callback_data.number].name
+        city_id = await register_city(city)
+
+        await respond(
+            callback,
+            f"Город *{city}* найден.\nВыберите действие:",
+            reply_markup=new_city_actions(city_id)
         )
 
-    @dp.callback_query(F.data.startswith("city_"))
-    async def selected_city(callback: CallbackQuery):
-        city = callback.data.replace("city_", "")
-        weather = get_weather(city)
+    @dp.callback_query(F.data == "check_typed", flags={"heavy": True})
+    async def check_city(callback: CallbackQuery):
+        """Введённое название не из справочника — проверяем геокодером."""
+        city = _pending_cities.get(callback.from_user.id)
+        if city is MISSING:
+            await respond(callback, "❌ Город не найден, введите его заново.", reply_markup=back_menu())
+            return
+
+        lat, lon = await get_coords(city)
+        if lat is None:
+            await respond(callback, "❌ Город не найден, попробуйте снова.")
+            return
 
-        await callback.message.answer(weather)
-        await callback.message.answer(
-            "Выберите действие:",
-            reply_markup=new_city_actions(city)
+        _pending_cities.pop(callback.from_user.id)
+        city_id = await register_city(city)
+
+        await respond(
+            callback,
+            f"Город *{city}* найден.\nВыберите действие:",
+            reply_markup=new_city_actions(city_id)
         )
 
-    @dp.callback_query(F.data.startswith("make_default_"))
-    async def make_default(callback: CallbackQuery):
+    @dp.callback_query(CityAction.filter(F.action == "default"))
+    async def make_default(callback: CallbackQuery, callback_data: CityAction):
         user_id = callback.from_user.id
-        city = callback.data.replace("make_default_", "")
-        save_default_city(user_id, city)
+        city = await city_from_callback(callback, callback_data)
+        if city is None:
+            return
 
-        await callback.message.answer(f"⭐ Город *{city}* установлен как основной.")
-        await callback.message.answer(
+        await save_default_city(user_id, city)
+
+        await respond(
+            callback,
+            f"⭐ Город *{city}* установлен как основной.",
             f"🌆 Ваш основной город: *{city}*",
-            reply_markup=main_menu(city)
+            main_menu(city)
         )
 
-    @dp.callback_query(F.data.startswith("save_city_"))
-    async def save_city(callback: CallbackQuery):
+    @dp.callback_query(CityAction.filter(F.action == "save"))
+    async def save_city(callback: CallbackQuery, callback_data: CityAction):
         user_id = callback.from_user.id
-        city = callback.data.replace("save_city_", "")
-        add_city(user_id, city)
+        city = await city_from_callback(callback, callback_data)
+        if city is None:
+            return
 
-        await callback.message.answer(f"📌 Город *{city}* добавлен в список.")
-        await callback.message.answer(
-            f"🌆 Ваш основной город: *{get_default_city(user_id)}*",
-            reply_markup=main_menu(get_default_city(user_id))
-        )
+        added = await add_city(user_id, city)
+        default_city = await get_default_city(user_id)
 
-    @dp.callback_query(F.data.startswith("just_show_"))
-    async def just_show(callback: CallbackQuery):
-        city = callback.data.replace("just_show_", "")
-        text = get_weather(city)
+        if added:
+            text = f"📌 Город *{city}* добавлен в список."
+        else:
+            text = f"📌 Город *{city}* уже в списке или список заполнен."
 
-        await callback.message.answer(text)
-        await callback.message.answer(
-            "Выберите действие:",
-            reply_markup=new_city_actions(city)
-        )
+        await respond(callback, text, f"🌆 Ваш основной город: *{default_city}*", main_menu(default_city))
+
+    @dp.callback_query(CityAction.filter(F.action == "show"), flags={"heavy": True})
+    async def just_show(callback: CallbackQuery, callback_data: CityAction):
+        city = await city_from_callback(callback, callback_data)
+        if city is None:
+            return
+
+        text = await get_weather(city)
+
+        await respond(callback, text, "Выберите действие:", new_city_actions(callback_data.city_id))
 
     @dp.callback_query(F.data == "subscription")
     async def subscription_menu_open(callback: CallbackQuery):
         user_id = callback.from_user.id
-        time = get_sub_time(user_id)
+        time = await get_sub_time(user_id)
 
         text = (
             "🕒 *Ежедневная рассылка погоды*\n\n"
@@ -232,33 +390,40 @@ async def main():
             f"Текущее время рассылки: *{time if time else 'не задано'}*\n"
         )
 
-        await callback.message.answer(
-            text,
-            reply_markup=subscription_menu()
-        )
+        await respond(callback, text, reply_markup=subscription_menu())
 
     @dp.callback_query(F.data == "sub_set")
     async def subscription_set(callback: CallbackQuery):
-        await callback.message.answer(
-            "⌚ Введите время для рассылки в формате `14-30`:",
-            reply_markup=None
-        )
+        await respond(callback, "⌚ Введите время для рассылки в формате `14-30`:", reply_markup=back_menu())
+
+    @dp.callback_query(F.data == "add_city")
+    async def add_city_prompt(callback: CallbackQuery):
+        await respond(callback, "✏️ Введите название города:", reply_markup=back_menu())
+
+    @dp.callback_query(F.data == "back_main")
+    async def back_to_main(callback: CallbackQuery):
+        user_id = callback.from_user.id
+        city = await get_default_city(user_id)
+
+        if not city:
+            await respond(callback, "Введите ваш город (например: Москва):")
+            return
+
+        await respond(callback, f"🌆 Ваш основной город: *{city}*", reply_markup=main_menu(city))
 
     @dp.callback_query(F.data == "sub_cancel")
     async def subscription_cancel(callback: CallbackQuery):
         user_id = callback.from_user.id
-        delete_sub(user_id)
+        await delete_sub(user_id)
+        subscriptions.remove(user_id)
+        city = await get_default_city(user_id)
 
-        await callback.message.answer("❌ Рассылка отменена.")
-        await callback.message.answer(
-            f"🌆 Ваш основной город: *{get_default_city(user_id)}*",
-            reply_markup=main_menu(get_default_city(user_id))
-        )
+        await respond(callback, "❌ Рассылка отменена.", f"🌆 Ваш основной город: *{city}*", main_menu(city))
 
     @dp.callback_query(F.data == "help")
     async def help_callback(callback: CallbackQuery):
         user_id = callback.from_user.id
-        city = get_default_city(user_id)
+        city = await get_default_city(user_id)
 
         help_text = (
             "ℹ️ *Помощь по боту погоды*\n\n"
@@ -278,23 +443,61 @@ async def main():
             "Если что-то работает не так, как ожидаете — просто напишите новый город или нажмите 🏠 Меню."
         ).format(city=city if city else "вашем городе")
 
-        # отправляем помощь отдельным сообщением
-        await callback.message.answer(help_text)
-
-        # и сразу следом — меню
+        # помощь и меню — одним ответом
         if city:
-            await callback.message.answer(
-                f"🌆 Ваш основной город: *{city}*",
-                reply_markup=main_menu(city)
-            )
+            await respond(callback, help_text, f"🌆 Ваш основной город: *{city}*", main_menu(city))
         else:
-            await callback.message.answer(
+            await respond(
+                callback,
+                help_text,
                 "У вас ещё не задан основной город. Введите его текстом (например: Москва)."
             )
 
+    return dp
+
+
+async def main():
+    init_db()
+    if PROFILE_CACHE_TTL is not None:
+        set_profile_cache_ttl(PROFILE_CACHE_TTL)
+    # справочник городов грузим заранее, а не на первом апдейте
+    get_city_index()
+
+    bot = Bot(
+        token=TOKEN,
+        default=DefaultBotProperties(parse_mode="Markdown")
+    )
+    dp = create_dispatcher()
+
+    if TRACING:
+        # по строке JSON на апдейт — без префиксов, чтобы читалось сборщиком логов
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_logger = logging.getLogger("trace")
+        trace_logger.addHandler(handler)
+        trace_logger.setLevel(logging.INFO)
+        trace_logger.propagate = False
+        bot.session.middleware(TracingRequestMiddleware())
+
+    scheduler_task = asyncio.create_task(scheduler(bot)) if RUN_SCHEDULER else None
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
 
     # запуск бота
-    await dp.start_polling(bot)
+    try:
+        if webhook_enabled():
+            await run_webhook(bot, dp)
+        else:
+            # start_polling сам webhook не снимает — без этого getUpdates
+            # после отключения WEBHOOK_URL падал бы с конфликтом
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if scheduler_task:
+            scheduler_task.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await close_session()
+        close_db()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,75 @@
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_REQUESTS
+
+MISSING = object()
+
+
+class TTLCache:
+    """LRU-кэш ограниченного размера с временем жизни записей.
+
+    stale_ttl — сколько ещё хранить истёкшую запись: get её уже не отдаёт,
+    а get_stale отдаёт с пометкой «устарела».
+    """
+
+    def __init__(self, maxsize: int, ttl: float, name: str | None = None, stale_ttl: float = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()
+
+    def _count(self, result: str):
+        if self.name:
+            CACHE_REQUESTS.inc(cache=self.name, result=result)
+
+    def get(self, key, default=MISSING):
+        value, fresh = self.get_stale(key)
+        return value if fresh else default
+
+    def get_stale(self, key):
+        """(значение, свежее ли оно); (MISSING, False), если записи нет."""
+        item = self._data.get(key)
+        if item is None:
+            self._count("miss")
+            return MISSING, False
+
+        value, expires_at = item
+        now = time.monotonic()
+        if expires_at + self.stale_ttl < now:
+            del self._data[key]
+            self._count("miss")
+            return MISSING, False
+
+        self._data.move_to_end(key)
+        if expires_at < now:
+            self._count("stale")
+            return value, False
+
+        self._count("hit")
+        return value, True
+
+    def remaining(self, key) -> float:
+        """Сколько секунд запись ещё свежая (0 — нет записи или истекла)."""
+        item = self._data.get(key)
+        if item is None:
+            return 0.0
+        return max(0.0, item[1] - time.monotonic())
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
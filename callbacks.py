@@ -0,0 +1,19 @@
+from aiogram.filters.callback_data import CallbackData
+
+
+class CityAction(CallbackData, prefix="c"):
+    """Действие с городом; город передаётся id из реестра, а не названием.
+
+    action: select — выбран из списка, default — сделать основным,
+    save — добавить в список, show — просто показать погоду.
+    """
+
+    action: str
+    city_id: int
+
+
+class CitySuggestion(CallbackData, prefix="p"):
+    """Вариант из справочника для неизвестного названия; number — позиция
+    в CityIndex.cities. В реестр город попадает только при нажатии."""
+
+    number: int
@@ -0,0 +1,171 @@
+import logging
+import os
+from array import array
+from bisect import bisect_left
+
+from utils import normalize_city
+
+logger = logging.getLogger(__name__)
+
+# Справочник городов в формате выгрузки GeoNames (cities15000.txt и т.п.).
+# В репозитории — крупные города; можно подложить полную выгрузку того же формата
+CITIES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cities.tsv")
+
+# Колонки выгрузки GeoNames, которые нам нужны
+COL_NAME, COL_ASCII, COL_ALTERNATE, COL_LAT, COL_LON, COL_POPULATION = 1, 2, 3, 4, 5, 14
+
+# Подсказки при опечатке: доля общих триграмм не ниже MIN_SIMILARITY
+MIN_SIMILARITY = 0.35
+SUGGESTIONS = 3
+
+
+class City:
+    __slots__ = ("name", "latitude", "longitude", "population", "number")
+
+    def __init__(self, name: str, latitude: float, longitude: float, population: int = 0):
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.population = population
+        # позиция в CityIndex.cities, задаётся справочником
+        self.number = -1
+
+    def __repr__(self):
+        return f"City({self.name!r}, {self.latitude}, {self.longitude})"
+
+
+def trigrams(key: str) -> set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class CityIndex:
+    """Города в памяти: точное совпадение, поиск по началу названия и по опечаткам.
+
+    Все названия (основное и варианты) нормализуются и лежат отсортированным
+    списком для поиска по префиксу; для нечёткого поиска — списки позиций по триграммам.
+    """
+
+    def __init__(self, cities):
+        self.cities: list[City] = []
+        exact: dict[str, int] = {}
+
+        for city, names in cities:
+            number = city.number = len(self.cities)
+            self.cities.append(city)
+
+            for name in names:
+                key = normalize_city(name)
+                other = exact.get(key)
+                # одноимённые города — по названию находим самый крупный
+                if key and (other is None or self.cities[other].population < city.population):
+                    exact[key] = number
+
+        self._exact = exact
+        self._keys = sorted(exact)
+        self._owners = array("I", (exact[key] for key in self._keys))
+        self._sizes = array("H")
+        self._postings: dict[str, array] = {}
+
+        for position, key in enumerate(self._keys):
+            grams = trigrams(key)
+            self._sizes.append(len(grams))
+            for gram in grams:
+                posting = self._postings.get(gram)
+                if posting is None:
+                    posting = self._postings[gram] = array("I")
+                posting.append(position)
+
+    def __len__(self):
+        return len(self.cities)
+
+    def lookup(self, text: str) -> City | None:
+        """Город по точному названию (без учёта регистра, ё/е и пробелов)."""
+        number = self._exact.get(normalize_city(text))
+        return None if number is None else self.cities[number]
+
+    def complete(self, text: str, limit: int = SUGGESTIONS) -> list[City]:
+        """Крупнейшие города, название которых начинается с text."""
+        prefix = normalize_city(text)
+        if not prefix:
+            return []
+
+        found = set()
+        for position in range(bisect_left(self._keys, prefix), len(self._keys)):
+            if not self._keys[position].startswith(prefix):
+                break
+            found.add(self._owners[position])
+
+        cities = sorted((self.cities[n] for n in found), key=lambda c: -c.population)
+        return cities[:limit]
+
+    def fuzzy(self, text: str, limit: int = SUGGESTIONS) -> list[City]:
+        """Похожие названия: по доле общих триграмм, при равенстве — крупнее выше."""
+        grams = trigrams(normalize_city(text))
+
+        shared: dict[int, int] = {}
+        for gram in grams:
+            for position in self._postings.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+
+        best: dict[int, float] = {}
+        for position, count in shared.items():
+            similarity = count / (len(grams) + self._sizes[position] - count)
+            if similarity < MIN_SIMILARITY:
+                continue
+            number = self._owners[position]
+            if similarity > best.get(number, 0):
+                best[number] = similarity
+
+        ranked = sorted(best, key=lambda n: (-best[n], -self.cities[n].population))
+        return [self.cities[n] for n in ranked[:limit]]
+
+    def suggest(self, text: str, limit: int = SUGGESTIONS) -> list[City]:
+        """Варианты для неизвестного названия: сначала по началу, затем по опечаткам."""
+        result = []
+        if len(normalize_city(text)) >= 3:
+            result = self.complete(text, limit)
+
+        for city in self.fuzzy(text, limit):
+            if len(result) >= limit:
+                break
+            if city not in result:
+                result.append(city)
+
+        return result
+
+
+def _is_cyrillic(name: str) -> bool:
+    return any("а" <= ch <= "я" or ch == "ё" for ch in name.lower())
+
+
+def read_geonames(path: str):
+    """(City, все названия) из выгрузки GeoNames; показываем русское название, если оно есть."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) <= COL_POPULATION:
+                continue
+
+            alternate = [a for a in cols[COL_ALTERNATE].split(",") if a]
+            name = next((a for a in alternate if _is_cyrillic(a)), cols[COL_NAME])
+            city = City(name, float(cols[COL_LAT]), float(cols[COL_LON]), int(cols[COL_POPULATION] or 0))
+
+            yield city, {cols[COL_NAME], cols[COL_ASCII], *alternate}
+
+
+_index: CityIndex | None = None
+
+
+def get_city_index() -> CityIndex:
+    """Общий справочник; загружается при первом обращении."""
+    global _index
+
+    if _index is None:
+        if os.path.exists(CITIES_FILE):
+            _index = CityIndex(read_geonames(CITIES_FILE))
+        else:
+            logger.warning("Справочник городов %s не найден, проверка только через геокодер", CITIES_FILE)
+            _index = CityIndex(())
+
+    return _index
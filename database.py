@@ -1,10 +1,108 @@
+import asyncio
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache, MISSING
+from metrics import DB_SECONDS
+from tracing import span
+from utils import normalize_city
 
 DB_NAME = "users.db"
 
+# Сколько городов пользователь может сохранить в список
+MAX_CITIES = 20
+
+# Одно долгоживущее соединение; все запросы выполняются в отдельном потоке,
+# чтобы не блокировать event loop
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA busy_timeout=5000",
+)
+
+# Кэш профилей: основной город, список городов и время рассылки.
+# Все записи идут через функции этого модуля, поэтому кэш сквозной — но только
+# в пределах процесса: у нескольких экземпляров бота TTL нужно уменьшать
+PROFILE_CACHE_SIZE = 50_000
+PROFILE_CACHE_TTL = 3600
+
+_default_city_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, name="default_city")
+_cities_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, name="cities")
+_sub_time_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, name="sub_time")
+
+# Записи реестра городов не меняются, кэшируем надолго
+_city_id_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=24 * 3600, name="city_id")
+_city_name_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=24 * 3600, name="city_name")
+
+_conn: sqlite3.Connection | None = None
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+
+def set_profile_cache_ttl(ttl: float):
+    """Время жизни кэша профилей; 0 — кэш выключен."""
+    for cache in (_default_city_cache, _cities_cache, _sub_time_cache):
+        cache.ttl = ttl
+        cache.clear()
+
+
+def get_connection() -> sqlite3.Connection:
+    global _conn
+
+    if _conn is None:
+        _conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+        for pragma in PRAGMAS:
+            _conn.execute(pragma)
+
+    return _conn
+
+
+def close_db():
+    global _conn
+
+    if _conn is not None:
+        _conn.close()
+        _conn = None
+
+
+async def _run(query: str, func, *args):
+    """func(*args) в потоке SQLite; query — имя запроса для метрик и трассировки."""
+    loop = asyncio.get_running_loop()
+    with DB_SECONDS.time(query=query), span("db", query=query):
+        return await loop.run_in_executor(_executor, func, *args)
+
+
+def _fetchone_sync(sql, params):
+    return get_connection().execute(sql, params).fetchone()
+
+
+def _fetchall_sync(sql, params):
+    return get_connection().execute(sql, params).fetchall()
+
+
+def _execute_sync(sql, params):
+    conn = get_connection()
+    conn.execute(sql, params)
+    conn.commit()
+
+
+async def _fetchone(query, sql, params=()):
+    return await _run(query, _fetchone_sync, sql, params)
+
+
+async def _fetchall(query, sql, params=()):
+    return await _run(query, _fetchall_sync, sql, params)
+
+
+async def _execute(query, sql, params=()):
+    await _run(query, _execute_sync, sql, params)
+
 
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
+    conn = get_connection()
     cur = conn.cursor()
 
     cur.execute("""
@@ -29,91 +127,312 @@ def init_db():
         )
     """)
 
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            user_id INTEGER PRIMARY KEY
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS geocache (
+            key TEXT PRIMARY KEY,
+            latitude REAL,
+            longitude REAL,
+            expires_at REAL
+        )
+    """)
+
     conn.commit()
-    conn.close()
+    migrate(conn)
 
 
-def get_default_city(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+def _migration_1(cur):
+    """Нормализованные ключи городов, без дублей, и индексы для выборок."""
+    cur.execute("ALTER TABLE cities ADD COLUMN city_key TEXT")
+    cur.execute("UPDATE cities SET city_key = normalize_city(city)")
+    cur.execute("""
+        DELETE FROM cities WHERE id NOT IN (
+            SELECT MIN(id) FROM cities GROUP BY user_id, city_key
+        )
+    """)
+    cur.execute("CREATE UNIQUE INDEX idx_cities_user_key ON cities (user_id, city_key)")
+    cur.execute("CREATE INDEX idx_subscriptions_time ON subscriptions (time)")
 
-    cur.execute("SELECT default_city FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
 
-    conn.close()
-    return row[0] if row else None
+def _migration_2(cur):
+    """Журнал рассылки: кто уже получил прогноз за день."""
+    cur.execute("""
+        CREATE TABLE broadcast_log (
+            user_id INTEGER,
+            day TEXT,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    """)
 
 
-def save_default_city(user_id, city):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+def _migration_3(cur):
+    """Реестр городов: короткие числовые id для callback_data."""
+    cur.execute("""
+        CREATE TABLE city_registry (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            key TEXT NOT NULL UNIQUE
+        )
+    """)
 
+
+def _migration_4(cur):
+    """Аренда записи рассылки: до подтверждения доставки leased_until — срок аренды."""
+    cur.execute("ALTER TABLE broadcast_log ADD COLUMN leased_until REAL")
+
+
+# Миграции схемы по порядку; номер версии хранится в PRAGMA user_version
+MIGRATIONS = [
+    _migration_1,
+    _migration_2,
+    _migration_3,
+    _migration_4,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    conn.create_function("normalize_city", 1, normalize_city, deterministic=True)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # модуль sqlite3 сам открывает транзакцию только перед DML, а ALTER/CREATE
+        # фиксировались бы сразу — открываем её явно, чтобы миграция шла целиком
+        conn.execute("BEGIN")
+        try:
+            migration(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {number}")
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+async def get_default_city(user_id):
+    city = _default_city_cache.get(user_id)
+    if city is not MISSING:
+        return city
+
+    row = await _fetchone("get_default_city", "SELECT default_city FROM users WHERE user_id=?", (user_id,))
+    city = row[0] if row else None
+    _default_city_cache.set(user_id, city)
+    return city
+
+
+async def save_default_city(user_id, city):
     # ВАЖНО: параметры должны быть переданы
-    cur.execute("""
+    await _execute("save_default_city", """
         INSERT INTO users (user_id, default_city)
         VALUES (?, ?)
         ON CONFLICT(user_id) DO UPDATE SET default_city = excluded.default_city
     """, (user_id, city))
+    _default_city_cache.set(user_id, city)
 
-    conn.commit()
-    conn.close()
-
-
-def add_city(user_id, city):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-
-    cur.execute("INSERT INTO cities (user_id, city) VALUES (?, ?)", (user_id, city))
 
+def _add_city_sync(user_id, city):
+    conn = get_connection()
+    cur = conn.execute("""
+        INSERT OR IGNORE INTO cities (user_id, city, city_key)
+        SELECT ?, ?, ?
+        WHERE (SELECT COUNT(*) FROM cities WHERE user_id = ?) < ?
+    """, (user_id, city, normalize_city(city), user_id, MAX_CITIES))
     conn.commit()
-    conn.close()
+    return cur.rowcount > 0
 
 
-def get_cities(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
+async def add_city(user_id, city):
+    """Добавляет город в список. False — если он уже есть или список заполнен."""
+    added = await _run("add_city", _add_city_sync, user_id, city)
+    _cities_cache.pop(user_id)
+    return added
 
-    cur.execute("SELECT city FROM cities WHERE user_id=?", (user_id,))
-    rows = cur.fetchall()
 
-    conn.close()
-    return [r[0] for r in rows]
+async def get_cities(user_id):
+    cities = _cities_cache.get(user_id)
+    if cities is not MISSING:
+        return list(cities)
 
+    rows = await _fetchall("get_cities", "SELECT city FROM cities WHERE user_id=? ORDER BY id", (user_id,))
+    cities = tuple(r[0] for r in rows)
+    _cities_cache.set(user_id, cities)
+    return list(cities)
 
-def set_sub_time(user_id, time_str):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("""
+
+async def set_sub_time(user_id, time_str):
+    await _execute("set_sub_time", """
         INSERT INTO subscriptions (user_id, time)
         VALUES (?, ?)
         ON CONFLICT(user_id) DO UPDATE SET time = excluded.time
     """, (user_id, time_str))
-    conn.commit()
-    conn.close()
+    _sub_time_cache.set(user_id, time_str)
+
+
+async def get_sub_time(user_id):
+    time_str = _sub_time_cache.get(user_id)
+    if time_str is not MISSING:
+        return time_str
+
+    row = await _fetchone("get_sub_time", "SELECT time FROM subscriptions WHERE user_id=?", (user_id,))
+    time_str = row[0] if row else None
+    _sub_time_cache.set(user_id, time_str)
+    return time_str
+
+
+async def delete_sub(user_id):
+    await _execute("delete_sub", "DELETE FROM subscriptions WHERE user_id=?", (user_id,))
+    _sub_time_cache.pop(user_id)
+
+
+async def get_all_subscriptions():
+    return await _fetchall("get_all_subscriptions", "SELECT user_id, time FROM subscriptions")
+
+
+async def get_due_subscribers(times, day, shard=0, shards=1):
+    """Подписчики на время из списка times, ещё не получившие рассылку за day,
+    вместе с их основным городом.
+
+    Пропускаются и те, чья запись сейчас в действующей аренде у другого воркера.
+    shard/shards — доля пользователей (по user_id) для одного воркера рассылки.
+    """
+    marks = ",".join("?" * len(times))
+    return await _fetchall("get_due_subscribers", f"""
+        SELECT s.user_id, u.default_city
+        FROM subscriptions s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE s.time IN ({marks}) AND u.default_city IS NOT NULL
+          AND s.user_id % ? = ?
+          AND s.user_id NOT IN (SELECT user_id FROM blocked_users)
+          AND NOT EXISTS (
+              SELECT 1 FROM broadcast_log b
+              WHERE b.user_id = s.user_id AND b.day = ?
+                AND (b.leased_until IS NULL OR b.leased_until > ?)
+          )
+    """, (*times, shards, shard, day, time.time()))
+
+
+async def get_upcoming_cities(times, shard=0, shards=1):
+    """Основные города подписчиков на время из списка times — без повторов."""
+    marks = ",".join("?" * len(times))
+    rows = await _fetchall("get_upcoming_cities", f"""
+        SELECT DISTINCT u.default_city
+        FROM subscriptions s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE s.time IN ({marks}) AND u.default_city IS NOT NULL
+          AND s.user_id % ? = ?
+    """, (*times, shards, shard))
+    return [r[0] for r in rows]
 
 
-def get_sub_time(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT time FROM subscriptions WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
+def _claim_broadcast_sync(user_ids, day, lease):
+    conn = get_connection()
+    now = time.time()
+    claimed = []
+    with conn:
+        for user_id in user_ids:
+            # новая запись или просроченная аренда упавшего воркера
+            cur = conn.execute("""
+                INSERT INTO broadcast_log (user_id, day, leased_until) VALUES (?, ?, ?)
+                ON CONFLICT(user_id, day) DO UPDATE SET leased_until = excluded.leased_until
+                WHERE broadcast_log.leased_until IS NOT NULL AND broadcast_log.leased_until <= ?
+            """, (user_id, day, now + lease, now))
+            if cur.rowcount:
+                claimed.append(user_id)
+    return claimed
 
 
-def delete_sub(user_id):
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM subscriptions WHERE user_id=?", (user_id,))
+async def claim_broadcast(user_ids, day, lease):
+    """Берёт рассылку за день в аренду на lease секунд; возвращает тех, кого
+    ещё никто не взял и кому ещё не доставлено."""
+    return await _run("claim_broadcast", _claim_broadcast_sync, list(user_ids), day, lease)
+
+
+def _finish_broadcast_sync(user_ids, day, delivered):
+    conn = get_connection()
+    params = [(user_id, day) for user_id in user_ids]
+    with conn:
+        if delivered:
+            conn.executemany(
+                "UPDATE broadcast_log SET leased_until = NULL WHERE user_id = ? AND day = ?", params
+            )
+        else:
+            conn.executemany(
+                "DELETE FROM broadcast_log WHERE user_id = ? AND day = ? AND leased_until IS NOT NULL",
+                params
+            )
+
+
+async def confirm_broadcast(user_ids, day):
+    """Рассылка за день завершена — больше этим пользователям её не отправлять."""
+    await _run("confirm_broadcast", _finish_broadcast_sync, list(user_ids), day, True)
+
+
+async def release_broadcast(user_ids, day):
+    """Снимает аренду недоставленных — их подберёт следующий проход планировщика."""
+    await _run("release_broadcast", _finish_broadcast_sync, list(user_ids), day, False)
+
+
+async def purge_broadcast_log(before_day):
+    await _execute("purge_broadcast_log", "DELETE FROM broadcast_log WHERE day < ?", (before_day,))
+
+
+async def mark_blocked(user_id):
+    await _execute("mark_blocked", "INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)", (user_id,))
+
+
+async def unmark_blocked(user_id):
+    await _execute("unmark_blocked", "DELETE FROM blocked_users WHERE user_id=?", (user_id,))
+
+
+def _register_city_sync(name, key):
+    conn = get_connection()
+    conn.execute("INSERT OR IGNORE INTO city_registry (name, key) VALUES (?, ?)", (name, key))
     conn.commit()
-    conn.close()
+    return conn.execute("SELECT id, name FROM city_registry WHERE key=?", (key,)).fetchone()
 
 
-def get_all_subscriptions():
-    conn = sqlite3.connect(DB_NAME)
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, time FROM subscriptions")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+async def register_city(name):
+    """Числовой id города в реестре (создаётся при первом обращении)."""
+    key = normalize_city(name)
+
+    city_id = _city_id_cache.get(key)
+    if city_id is not MISSING:
+        return city_id
+
+    city_id, registered_name = await _run("register_city", _register_city_sync, name, key)
+    _city_id_cache.set(key, city_id)
+    _city_name_cache.set(city_id, registered_name)
+    return city_id
+
+
+async def get_city_name(city_id):
+    name = _city_name_cache.get(city_id)
+    if name is not MISSING:
+        return name
+
+    row = await _fetchone("get_city_name", "SELECT name FROM city_registry WHERE id=?", (city_id,))
+    name = row[0] if row else None
+    if name is not None:
+        _city_name_cache.set(city_id, name)
+    return name
+
+
+async def get_geocode(key):
+    return await _fetchone(
+        "get_geocode",
+        "SELECT latitude, longitude, expires_at FROM geocache WHERE key=?", (key,)
+    )
+
 
+async def save_geocode(key, latitude, longitude, expires_at):
+    await _execute("save_geocode", """
+        INSERT INTO geocache (key, latitude, longitude, expires_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET
+            latitude = excluded.latitude,
+            longitude = excluded.longitude,
+            expires_at = excluded.expires_at
+    """, (key, latitude, longitude, expires_at))
@@ -1,6 +1,49 @@
-import requests
+import asyncio
+import itertools
+import logging
+import time
+from array import array
 from datetime import datetime, timedelta
-from collections import Counter
+from functools import lru_cache
+
+from cache import TTLCache, MISSING
+from http_client import fetch_json, UpstreamError
+from singleflight import SingleFlight
+from tracing import span
+from geocoding import get_coords
+
+logger = logging.getLogger(__name__)
+
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+
+# Open-Meteo обновляет текущие данные раз в 15 минут —
+# кэш живёт до ближайшей границы обновления
+UPDATE_INTERVAL = 15 * 60
+
+# Округление координат: соседние точки одного города делят одну запись
+COORD_PRECISION = 2
+
+# Ограничение длины URL пакетного запроса нескольких точек
+MAX_URL_LENGTH = 4000
+
+# Части дня в прогнозе: (название, первый час, последний час), без пересечений
+DAY_PARTS = (
+    ("🌅 Утро", 7, 9),
+    ("🌞 День", 12, 14),
+    ("🌇 Вечер", 18, 20),
+)
+
+# Устаревший прогноз ещё STALE_TTL секунд отдаётся сразу, пока свежий
+# загружается в фоне, — и выручает, когда Open-Meteo недоступен
+STALE_TTL = 6 * 3600
+
+forecast_cache = TTLCache(maxsize=5000, ttl=UPDATE_INTERVAL, name="forecast", stale_ttl=STALE_TTL)
+_inflight = SingleFlight()
+_background = set()
+
+# Готовые тексты сообщений: (город, вид, дата, версия прогноза) → текст
+rendered_cache = TTLCache(maxsize=20_000, ttl=UPDATE_INTERVAL, name="rendered")
+_versions = itertools.count(1)
 
 # Таблица расшифровки кодов Open-Meteo
 WEATHER_CODES = {
@@ -45,117 +88,259 @@ WEATHER_CODES = {
 }
 
 
-def get_coords(city: str):
-    """Получение координат города."""
-    url = f"https://geocoding-api.open-meteo.com/v1/search?name={city}&count=1&language=ru"
-    data = requests.get(url).json()
-    if "results" not in data:
-        return None, None
+class Forecast:
+    """Ответ Open-Meteo, разобранный один раз: текущая погода и почасовые ряды по дням."""
+
+    __slots__ = ("current", "days", "version")
+
+    def __init__(self, data: dict):
+        if "current_weather" not in data or "hourly" not in data:
+            raise UpstreamError("Open-Meteo: в ответе нет current_weather/hourly")
+
+        self.current = data["current_weather"]
+        self.days = parse_hourly(data["hourly"])
+        # новая загрузка — новая версия, старые готовые тексты больше не подходят
+        self.version = next(_versions)
+
 
-    r = data["results"][0]
-    return r["latitude"], r["longitude"]
+def parse_hourly(hourly) -> dict[str, tuple[array, array, array]]:
+    """Почасовой прогноз → {дата: (часы, температуры, коды)} в компактных массивах."""
+    days = {}
+    if not hourly:
+        return days
+
+    for t, temp, code in zip(hourly["time"], hourly["temperature_2m"], hourly["weathercode"]):
+        if temp is None or code is None:
+            continue
+
+        day = days.get(t[:10])
+        if day is None:
+            day = days[t[:10]] = (array("b"), array("d"), array("h"))
+
+        day[0].append(int(t[11:13]))
+        day[1].append(temp)
+        day[2].append(code)
+
+    return days
+
+
+def forecast_key(lat: float, lon: float):
+    return round(lat, COORD_PRECISION), round(lon, COORD_PRECISION)
+
+
+def seconds_to_update():
+    return UPDATE_INTERVAL - time.time() % UPDATE_INTERVAL
+
+
+async def load_forecast(lat: float, lon: float):
+    """Полный ответ Open-Meteo (текущая погода + почасовой прогноз) с кэшем.
+
+    Устаревшая запись отдаётся сразу, а обновляется в фоне.
+    """
+    key = forecast_key(lat, lon)
 
+    data, fresh = forecast_cache.get_stale(key)
+    if data is MISSING:
+        return await _inflight.do(key, _fetch_forecast, key)
 
-def load_hourly(city: str, tomorrow: bool = False):
-    """Загрузка почасового прогноза на нужный день."""
-    lat, lon = get_coords(city)
-    if not lat:
-        return None
+    if not fresh and key not in _inflight:
+        task = asyncio.create_task(_revalidate(key))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
 
-    date = (datetime.now() + timedelta(days=1)).date().isoformat() if tomorrow else datetime.now().date().isoformat()
+    return data
 
-    url = (
-        f"https://api.open-meteo.com/v1/forecast?"
-        f"latitude={lat}&longitude={lon}"
-        f"&hourly=temperature_2m,weathercode"
-        f"&timezone=auto"
+
+async def _revalidate(key):
+    try:
+        await _inflight.do(key, _fetch_forecast, key)
+    except UpstreamError as e:
+        logger.warning("Не удалось обновить прогноз %s: %s", key, e)
+
+
+async def _fetch_forecast(key):
+    data = await fetch_json(
+        FORECAST_URL,
+        {
+            "latitude": key[0],
+            "longitude": key[1],
+            "current_weather": "true",
+            "hourly": "temperature_2m,weathercode",
+            "timezone": "auto",
+        }
     )
 
-    data = requests.get(url).json()
+    forecast = Forecast(data)
+    forecast_cache.set(key, forecast, ttl=seconds_to_update())
+    return forecast
+
+
+def chunk_by_url_length(keys, limit: int = MAX_URL_LENGTH):
+    """Делит координаты на пачки, чтобы URL запроса не превышал limit."""
+    base = len(FORECAST_URL) + 150  # остальные параметры запроса
+    chunk, length = [], base
+
+    for key in keys:
+        size = len(str(key[0])) + len(str(key[1])) + 6  # запятые в URL-кодировке
+        if chunk and length + size > limit:
+            yield chunk
+            chunk, length = [], base
+        chunk.append(key)
+        length += size
+
+    if chunk:
+        yield chunk
+
+
+async def _fetch_batch(keys, min_ttl: float = 0):
+    data = await fetch_json(
+        FORECAST_URL,
+        {
+            "latitude": ",".join(str(k[0]) for k in keys),
+            "longitude": ",".join(str(k[1]) for k in keys),
+            "current_weather": "true",
+            "hourly": "temperature_2m,weathercode",
+            "timezone": "auto",
+        }
+    )
+
+    # для одной точки Open-Meteo отвечает объектом, для нескольких — списком
+    results = [Forecast(item) for item in (data if isinstance(data, list) else [data])]
+
+    ttl = max(seconds_to_update(), min_ttl)
+    for key, result in zip(keys, results):
+        forecast_cache.set(key, result, ttl=ttl)
+
+    return dict(zip(keys, results))
+
+
+async def load_forecasts(coords, min_ttl: float = 0):
+    """Прогнозы для многих точек сразу: недостающие — пачками по одному запросу.
+
+    min_ttl — не считать загруженное устаревшим раньше, чем через min_ttl секунд
+    (нужно предзагрузке, чтобы прогноз дожил до рассылки).
+    """
+    keys = list(dict.fromkeys(forecast_key(lat, lon) for lat, lon in coords))
+
+    found = {}
+    missing = []
+    for key in keys:
+        data = forecast_cache.get(key)
+        # запись, которая истечёт раньше min_ttl, всё равно обновляем —
+        # иначе к рассылке её не окажется в кэше
+        if data is MISSING or (min_ttl and forecast_cache.remaining(key) < min_ttl):
+            missing.append(key)
+        else:
+            found[key] = data
+
+    for chunk in chunk_by_url_length(missing):
+        found.update(await _fetch_batch(chunk, min_ttl))
 
-    times = data["hourly"]["time"]
-    temps = data["hourly"]["temperature_2m"]
-    codes = data["hourly"]["weathercode"]
+    return found
 
-    # оставляем только строки нужного дня
-    filtered = [
-        (t, temp, code)
-        for t, temp, code in zip(times, temps, codes)
-        if t.startswith(date)
-    ]
 
-    return filtered
+def forecast_date(tomorrow: bool = False) -> str:
+    day = datetime.now() + timedelta(days=1) if tomorrow else datetime.now()
+    return day.date().isoformat()
 
 
-def filter_interval(hourly, start_h, end_h):
+def render_cached(key, render, *args) -> str:
+    """Текст из кэша готовых сообщений или render(*args) с сохранением."""
+    text = rendered_cache.get(key)
+    if text is MISSING:
+        with span("render", view=render.__name__):
+            text = render(*args)
+        rendered_cache.set(key, text)
+    return text
+
+
+@lru_cache(maxsize=16)
+def _hour_index(parts) -> tuple[int, ...]:
+    """Номер части дня для каждого часа суток (-1 — час не входит ни в одну)."""
+    index = [-1] * 24
+    for i, (_, start_h, end_h) in enumerate(parts):
+        for hour in range(start_h, end_h + 1):
+            index[hour] = i
+    return tuple(index)
+
+
+def aggregate_day(day, parts=DAY_PARTS) -> dict:
     """
-    Берём диапазон часов (например 07–09),
-    считаем среднюю температуру,
-    выбираем наиболее частый weathercode.
+    За один проход по часам дня для каждой части дня
+    считаем среднюю температуру и наиболее частый weathercode.
     """
+    index = _hour_index(parts)
+    sums = [0.0] * len(parts)
+    counts = [0] * len(parts)
+    codes = [{} for _ in parts]
 
-    segment = []
-    for t, temp, code in hourly:
-        hour = int(t[11:13])
-        if start_h <= hour <= end_h:
-            segment.append((temp, code))
+    for hour, temp, code in zip(*day):
+        i = index[hour]
+        if i < 0:
+            continue
 
-    if not segment:
-        return None, None
+        sums[i] += temp
+        counts[i] += 1
+        codes[i][code] = codes[i].get(code, 0) + 1
 
-    # средняя температура
-    avg_temp = sum(t for t, _ in segment) / len(segment)
+    result = {}
+    for i, (part_name, _, _) in enumerate(parts):
+        if not counts[i]:
+            result[part_name] = (None, None)
+            continue
 
-    # наиболее частый weathercode
-    codes = [c for _, c in segment]
-    most_common = Counter(codes).most_common(1)[0][0]
-    weather_text = WEATHER_CODES.get(most_common, "Неизвестно")
+        most_common = max(codes[i], key=codes[i].get)
+        result[part_name] = (
+            round(sums[i] / counts[i], 1),
+            WEATHER_CODES.get(most_common, "Неизвестно"),
+        )
 
-    return round(avg_temp, 1), weather_text
+    return result
 
 
 def build_text(city: str, forecast: dict, tomorrow=False):
     header = "завтра" if tomorrow else "сегодня"
-    text = f"📅 *Прогноз на {header} — {city}:*\n\n"
+    parts = [f"📅 *Прогноз на {header} — {city}:*\n\n"]
 
     for part_name, data in forecast.items():
         temp, weather = data
 
         if temp is None:
-            text += f"*{part_name}:* нет данных\n\n"
+            parts.append(f"*{part_name}:* нет данных\n\n")
         else:
-            text += (
+            parts.append(
                 f"*{part_name}:*\n"
                 f"🌡 Температура: *{temp}°C*\n"
                 f"{weather}\n\n"
             )
 
-    return text
+    return "".join(parts)
 
 
-def get_today_text(city: str):
-    hourly = load_hourly(city, tomorrow=False)
-    if not hourly:
-        return "❌ Город не найден."
+def render_day(city: str, day, tomorrow: bool) -> str:
+    return build_text(city, aggregate_day(day), tomorrow=tomorrow)
 
-    forecast = {
-        "🌅 Утро": filter_interval(hourly, 7, 9),
-        "🌞 День": filter_interval(hourly, 12, 14),
-        "🌇 Вечер": filter_interval(hourly, 18, 20),
-    }
 
-    return build_text(city, forecast, tomorrow=False)
+async def get_day_text(city: str, tomorrow: bool = False):
+    """Прогноз на сегодня или завтра по частям дня."""
+    lat, lon = await get_coords(city)
+    if lat is None:
+        return "❌ Город не найден."
 
+    date = forecast_date(tomorrow)
+    forecast = await load_forecast(lat, lon)
 
-def get_tomorrow_text(city: str):
-    hourly = load_hourly(city, tomorrow=True)
-    if not hourly:
+    day = forecast.days.get(date)
+    if not day:
         return "❌ Город не найден."
 
-    forecast = {
-        "🌅 Утро": filter_interval(hourly, 7, 9),
-        "🌞 День": filter_interval(hourly, 12, 14),
-        "🌇 Вечер": filter_interval(hourly, 18, 20),
-    }
+    view = "tomorrow" if tomorrow else "today"
+    return render_cached((city, view, date, forecast.version), render_day, city, day, tomorrow)
+
+
+async def get_today_text(city: str):
+    return await get_day_text(city, tomorrow=False)
+
 
-    return build_text(city, forecast, tomorrow=True)
+async def get_tomorrow_text(city: str):
+    return await get_day_text(city, tomorrow=True)
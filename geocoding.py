@@ -0,0 +1,65 @@
+import time
+
+from cache import TTLCache, MISSING
+from city_index import get_city_index
+from database import get_geocode, save_geocode
+from http_client import fetch_json
+from singleflight import SingleFlight
+from utils import normalize_city
+
+GEOCODING_URL = "https://geocoding-api.open-meteo.com/v1/search"
+
+# Координаты городов не меняются — храним долго,
+# а «город не найден» — недолго, вдруг опечатку исправят в базе геокодера
+POSITIVE_TTL = 30 * 24 * 3600
+NEGATIVE_TTL = 3600
+
+_memory = TTLCache(maxsize=10_000, ttl=POSITIVE_TTL, name="geocoding")
+_inflight = SingleFlight()
+
+
+async def get_coords(city: str):
+    """Координаты города: кэш в памяти, справочник городов, SQLite, геокодер."""
+    if not city:
+        return None, None
+
+    key = normalize_city(city)
+
+    coords = _memory.get(key)
+    if coords is not MISSING:
+        return coords
+
+    known = get_city_index().lookup(key)
+    if known is not None:
+        coords = (known.latitude, known.longitude)
+        _memory.set(key, coords)
+        return coords
+
+    return await _inflight.do(key, _resolve, key, city)
+
+
+async def _resolve(key: str, city: str):
+    row = await get_geocode(key)
+    if row is not None:
+        lat, lon, expires_at = row
+        ttl = expires_at - time.time()
+        if ttl > 0:
+            _memory.set(key, (lat, lon), ttl=min(ttl, POSITIVE_TTL))
+            return lat, lon
+
+    data = await fetch_json(
+        GEOCODING_URL,
+        {"name": city, "count": 1, "language": "ru"}
+    )
+
+    if "results" in data:
+        r = data["results"][0]
+        coords = (r["latitude"], r["longitude"])
+        ttl = POSITIVE_TTL
+    else:
+        coords = (None, None)
+        ttl = NEGATIVE_TTL
+
+    _memory.set(key, coords, ttl=ttl)
+    await save_geocode(key, coords[0], coords[1], time.time() + ttl)
+    return coords
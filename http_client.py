@@ -0,0 +1,173 @@
+import asyncio
+import random
+import time
+
+import aiohttp
+
+from metrics import UPSTREAM_SECONDS, UPSTREAM_ERRORS, UPSTREAM_RETRIES, CIRCUIT_OPEN
+from tracing import span
+
+# Параметры пула соединений к Open-Meteo
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 20
+KEEPALIVE_TIMEOUT = 30
+
+# Таймауты запросов (секунды); у каждого эндпоинта свои
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10, connect=3)
+ENDPOINT_TIMEOUTS = {
+    "search": aiohttp.ClientTimeout(total=3, connect=1),
+    "forecast": aiohttp.ClientTimeout(total=6, connect=2),
+}
+
+# Повторы с экспоненциальной задержкой и случайным разбросом
+MAX_RETRIES = 2
+RETRY_BASE_DELAY = 0.2
+
+# Автомат защиты: после BREAKER_FAILURES ошибок подряд эндпоинт
+# «отключается» на BREAKER_RESET секунд, затем пробуем один запрос
+BREAKER_FAILURES = 5
+BREAKER_RESET = 30
+
+_session: aiohttp.ClientSession | None = None
+
+
+class UpstreamError(Exception):
+    """Open-Meteo не ответил или ответил ошибкой."""
+
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpenError(UpstreamError):
+    """Эндпоинт временно отключён автоматом защиты."""
+
+
+class CircuitBreaker:
+    def __init__(self, endpoint: str, failures: int = BREAKER_FAILURES, reset: float = BREAKER_RESET):
+        self.endpoint = endpoint
+        self.failures = failures
+        self.reset = reset
+        self._errors = 0
+        self._opened_at = None
+        self._trial = False
+
+    def before_request(self) -> bool:
+        """Разрешает запрос или бросает CircuitOpenError; True — это пробный запрос."""
+        if self._opened_at is None:
+            return False
+
+        if time.monotonic() - self._opened_at < self.reset or self._trial:
+            raise CircuitOpenError(f"{self.endpoint}: автомат защиты разомкнут")
+
+        # полуоткрытое состояние — пропускаем один пробный запрос
+        self._trial = True
+        return True
+
+    def end_trial(self):
+        # пробный запрос завершился ничем (например, отменён) — можно пробовать снова
+        self._trial = False
+
+    def success(self):
+        self._errors = 0
+        self._opened_at = None
+        self._trial = False
+        CIRCUIT_OPEN.set(0, endpoint=self.endpoint)
+
+    def failure(self):
+        self._errors += 1
+        self._trial = False
+        if self._errors >= self.failures:
+            self._opened_at = time.monotonic()
+            CIRCUIT_OPEN.set(1, endpoint=self.endpoint)
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    breaker = _breakers.get(endpoint)
+    if breaker is None:
+        breaker = _breakers[endpoint] = CircuitBreaker(endpoint)
+    return breaker
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Общая сессия aiohttp с пулом keep-alive соединений."""
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=REQUEST_TIMEOUT)
+
+    return _session
+
+
+async def _get_json(url: str, params: dict | None, timeout: aiohttp.ClientTimeout):
+    async with get_session().get(url, params=params, timeout=timeout) as resp:
+        if resp.status >= 400:
+            raise UpstreamError(f"{url}: HTTP {resp.status}", resp.status)
+        return await resp.json(content_type=None)
+
+
+def _retryable(error: Exception) -> bool:
+    # 4xx кроме 429 — ошибка самого запроса, повтор не поможет
+    if isinstance(error, UpstreamError) and error.status is not None:
+        return error.status >= 500 or error.status == 429
+    return True
+
+
+async def fetch_json(url: str, params: dict | None = None):
+    """GET-запрос с разбором JSON-ответа: таймауты, повторы и автомат защиты.
+
+    Все ошибки сети и Open-Meteo приходят наружу как UpstreamError.
+    """
+    endpoint = url.rsplit("/", 1)[-1]
+    timeout = ENDPOINT_TIMEOUTS.get(endpoint, REQUEST_TIMEOUT)
+    breaker = get_breaker(endpoint)
+
+    for attempt in range(MAX_RETRIES + 1):
+        trial = breaker.before_request()
+
+        try:
+            with UPSTREAM_SECONDS.time(endpoint=endpoint), span("upstream", endpoint=endpoint, attempt=attempt):
+                data = await _get_json(url, params, timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, UpstreamError) as e:
+            UPSTREAM_ERRORS.inc(endpoint=endpoint)
+            retryable = _retryable(e)
+
+            # автомат защиты реагирует только на сбои сервиса
+            if retryable:
+                breaker.failure()
+            else:
+                breaker.success()
+
+            if attempt == MAX_RETRIES or not retryable:
+                if isinstance(e, UpstreamError):
+                    raise
+                raise UpstreamError(f"{url}: {e!r}") from e
+
+            UPSTREAM_RETRIES.inc(endpoint=endpoint)
+            await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+            continue
+        finally:
+            # success()/failure() уже сбросили пробу; здесь — отмена и прочие исключения
+            if trial:
+                breaker.end_trial()
+
+        breaker.success()
+        return data
+
+
+async def close_session():
+    """Закрытие общей сессии при остановке бота."""
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
@@ -1,6 +1,12 @@
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+from callbacks import CityAction, CitySuggestion
+
 
+# Клавиатуры строятся один раз и переиспользуются — не изменяйте возвращаемые объекты
+@lru_cache(maxsize=4096)
 def main_menu(default_city: str):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"🌤 Погода в {default_city}", callback_data="show_weather")],
@@ -13,22 +19,33 @@ def main_menu(default_city: str):
     ])
 
 
+SUBSCRIPTION_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⏱ Установить / изменить время", callback_data="sub_set")],
+    [InlineKeyboardButton(text="❌ Отменить рассылку", callback_data="sub_cancel")],
+    [InlineKeyboardButton(text="⬅ Назад", callback_data="back_main")]
+])
+
+
 def subscription_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="⏱ Установить / изменить время", callback_data="sub_set")],
-        [InlineKeyboardButton(text="❌ Отменить рассылку", callback_data="sub_cancel")],
-        [InlineKeyboardButton(text="⬅ Назад", callback_data="back_main")]
-    ])
+    return SUBSCRIPTION_MENU
+
 
+BACK_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="⬅ Назад", callback_data="back_main")]
+])
 
 
-def city_choice_menu(cities: list[str]):
+def back_menu():
+    return BACK_MENU
+
+
+def city_choice_menu(cities: list[tuple[int, str]]):
     keyboard = []
 
-    for city in cities:
+    for city_id, city in cities:
         keyboard.append([InlineKeyboardButton(
             text=f"🏙 {city}",
-            callback_data=f"city_{city}"
+            callback_data=CityAction(action="select", city_id=city_id).pack()
         )])
 
     keyboard.append([InlineKeyboardButton(
@@ -39,19 +56,43 @@ def city_choice_menu(cities: list[str]):
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def new_city_actions(city: str):
+def city_suggestions_menu(suggestions: list[tuple[int, str]], typed: str):
+    """Варианты из справочника (номер, название) для неизвестного названия
+    и само название — проверить геокодером."""
+    keyboard = []
+
+    for number, city in suggestions:
+        keyboard.append([InlineKeyboardButton(
+            text=f"🏙 {city}",
+            callback_data=CitySuggestion(number=number).pack()
+        )])
+
+    keyboard.append([InlineKeyboardButton(
+        text=f"🔎 Искать «{typed}»",
+        callback_data="check_typed"
+    )])
+    keyboard.append([InlineKeyboardButton(
+        text="⬅ Назад",
+        callback_data="back_main"
+    )])
+
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+@lru_cache(maxsize=4096)
+def new_city_actions(city_id: int):
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(
             text="⭐ Сделать городом по умолчанию",
-            callback_data=f"make_default_{city}"
+            callback_data=CityAction(action="default", city_id=city_id).pack()
         )],
         [InlineKeyboardButton(
             text="📌 Добавить в список",
-            callback_data=f"save_city_{city}"
+            callback_data=CityAction(action="save", city_id=city_id).pack()
         )],
         [InlineKeyboardButton(
             text="👀 Просто показать погоду",
-            callback_data=f"just_show_{city}"
+            callback_data=CityAction(action="show", city_id=city_id).pack()
         )],
         [InlineKeyboardButton(
             text="⬅ Назад",
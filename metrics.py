@@ -0,0 +1,197 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+from tracing import annotate
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+
+
+def _labels_text(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = super().render()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_labels_text(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        item = self._values.get(key)
+        if item is None:
+            # счётчики по корзинам (+Inf последней), сумма
+            item = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = super().render()
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = _labels_text(self.labels + ("le",), key + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels_text(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ------------------------------------------------------------
+# Метрики бота
+# ------------------------------------------------------------
+
+UPSTREAM_SECONDS = Histogram(
+    "upstream_request_seconds", "Длительность запросов к Open-Meteo", ("endpoint",)
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_errors_total", "Ошибки запросов к Open-Meteo", ("endpoint",)
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total", "Повторные запросы к Open-Meteo", ("endpoint",)
+)
+CIRCUIT_OPEN = Gauge(
+    "upstream_circuit_open", "Автомат защиты эндпоинта разомкнут (1) или замкнут (0)", ("endpoint",)
+)
+DB_SECONDS = Histogram(
+    "db_query_seconds", "Длительность запросов к SQLite (с ожиданием очереди)", ("query",)
+)
+HANDLER_SECONDS = Histogram(
+    "handler_seconds", "Длительность обработки апдейта", ("handler",)
+)
+HANDLER_ERRORS = Counter(
+    "handler_errors_total", "Исключения в обработчиках", ("handler",)
+)
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Обращения к кэшам", ("cache", "result")
+)
+THROTTLED = Counter(
+    "throttled_updates_total", "Апдейты, отклонённые защитой от флуда", ("reason",)
+)
+MESSAGES_SENT = Counter(
+    "messages_sent_total", "Доставленные сообщения рассылки"
+)
+SEND_FAILURES = Counter(
+    "send_failures_total", "Недоставленные сообщения рассылки", ("reason",)
+)
+SEND_RETRIES = Counter(
+    "send_retries_total", "Повторные попытки отправки", ("reason",)
+)
+SEND_QUEUE = Gauge(
+    "send_queue_size", "Сообщений в очереди отправки"
+)
+SCHEDULER_LAG = Gauge(
+    "scheduler_lag_seconds", "Отставание планировщика от начала обрабатываемой минуты"
+)
+BROADCAST_SECONDS = Histogram(
+    "broadcast_seconds", "Длительность рассылки одной минуты",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600)
+)
+BROADCAST_RECIPIENTS = Counter(
+    "broadcast_recipients_total", "Получатели рассылки"
+)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время обработки каждого апдейта по имени обработчика."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        annotate(handler=name)
+
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+
+
+async def start_metrics_server(host: str, port: int | None):
+    """Запуск /metrics; возвращает runner для остановки или None, если выключено."""
+    if port is None:
+        return None
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
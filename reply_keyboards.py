@@ -1,8 +1,16 @@
 from aiogram.utils.keyboard import ReplyKeyboardBuilder
 
 
-def bottom_menu():
+def _build_bottom_menu():
     kb = ReplyKeyboardBuilder()
     kb.button(text="🏠 Меню")
     kb.adjust(1)
     return kb.as_markup(resize_keyboard=True)
+
+
+# Постоянная клавиатура одинакова для всех — строим один раз
+BOTTOM_MENU = _build_bottom_menu()
+
+
+def bottom_menu():
+    return BOTTOM_MENU
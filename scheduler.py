@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+
+from database import (
+    get_all_subscriptions, get_due_subscribers, get_upcoming_cities,
+    claim_broadcast, confirm_broadcast, release_broadcast, purge_broadcast_log
+)
+from forecast_api import get_today_text, load_forecasts
+from geocoding import get_coords
+from metrics import SCHEDULER_LAG, BROADCAST_SECONDS, BROADCAST_RECIPIENTS
+from sender import MessageSender, TokenBucket
+
+# Сколько пропущенных минут догоняем после зависания цикла
+MAX_CATCH_UP = 60
+
+# Сколько городов рассылки считаем одновременно
+FORECAST_CONCURRENCY = 20
+
+# Не получившие рассылку (прогноз не посчитался, сообщение не ушло, воркер
+# упал) подбираются следующими проходами в течение RETRY_WINDOW минут
+RETRY_WINDOW = 30
+
+# Аренда записи в журнале рассылки: за это время сообщения должны уйти,
+# иначе их подберёт другой воркер. Поэтому в аренду берём порциями, которые
+# отправитель успевает разослать за долю LEASE_SHARE аренды (с запасом на паузы flood control)
+BROADCAST_LEASE = 15 * 60
+LEASE_SHARE = 0.5
+
+# Предзагрузка прогнозов для рассылок в ближайшие минуты
+PREFETCH_MINUTES = 5
+PREFETCH_GEOCODING_RATE = 10
+
+logger = logging.getLogger(__name__)
+
+
+def minute_of_day(time_str: str) -> int:
+    hh, mm = time_str.split(":")
+    return int(hh) * 60 + int(mm)
+
+
+def current_minute() -> datetime:
+    return datetime.now().replace(second=0, microsecond=0)
+
+
+class SubscriptionIndex:
+    """Подписки, разложенные по минутам суток."""
+
+    def __init__(self):
+        self._by_minute: dict[int, set[int]] = defaultdict(set)
+        self._minute_of: dict[int, int] = {}
+
+    def load(self, rows):
+        self._by_minute.clear()
+        self._minute_of.clear()
+        for user_id, time_str in rows:
+            self.set(user_id, time_str)
+
+    def set(self, user_id: int, time_str: str):
+        self.remove(user_id)
+        minute = minute_of_day(time_str)
+        self._by_minute[minute].add(user_id)
+        self._minute_of[user_id] = minute
+
+    def remove(self, user_id: int):
+        minute = self._minute_of.pop(user_id, None)
+        if minute is None:
+            return
+
+        bucket = self._by_minute[minute]
+        bucket.discard(user_id)
+        if not bucket:
+            del self._by_minute[minute]
+
+    def due(self, minute: int) -> list[int]:
+        return list(self._by_minute.get(minute, ()))
+
+    def __len__(self):
+        return len(self._minute_of)
+
+
+subscriptions = SubscriptionIndex()
+
+
+def retry_window(slot: datetime) -> list[datetime]:
+    """Минуты, подписчиков которых проверяем на проходе slot, — без перехода через полночь."""
+    first = max(slot - timedelta(minutes=RETRY_WINDOW - 1), slot.replace(hour=0, minute=0))
+    return [first + timedelta(minutes=i) for i in range(int((slot - first).total_seconds()) // 60 + 1)]
+
+
+def group_by_city(rows) -> dict[str, list[int]]:
+    groups = defaultdict(list)
+    for user_id, city in rows:
+        groups[city].append(user_id)
+    return groups
+
+
+async def render_forecasts(cities) -> dict[str, str]:
+    """Текст прогноза для каждого города — по одному разу на город."""
+    semaphore = asyncio.Semaphore(FORECAST_CONCURRENCY)
+
+    async def render(city):
+        async with semaphore:
+            try:
+                return await get_today_text(city)
+            except Exception:
+                logger.exception("Не удалось подготовить прогноз рассылки для %s", city)
+                return None
+
+    cities = list(cities)
+    texts = await asyncio.gather(*(render(city) for city in cities))
+    return dict(zip(cities, texts))
+
+
+async def broadcast(sender: MessageSender, slot: datetime, shard: int = 0, shards: int = 1):
+    """Рассылка подписчикам на минуту slot, сгруппированным по городам,
+    и повтор для тех, кому за последние RETRY_WINDOW минут не доставлено."""
+    SCHEDULER_LAG.set((datetime.now() - slot).total_seconds())
+
+    with BROADCAST_SECONDS.time():
+        await _broadcast(sender, slot, shard, shards)
+
+
+async def _broadcast(sender: MessageSender, slot: datetime, shard: int, shards: int):
+    day = slot.date().isoformat()
+    times = [minute.strftime("%H:%M") for minute in retry_window(slot)]
+
+    rows = await get_due_subscribers(times, day, shard, shards)
+    if not rows:
+        return
+
+    groups = group_by_city(rows)
+    forecasts = await render_forecasts(groups)
+
+    # в аренду берём только тех, чей прогноз готов: остальных подберёт
+    # следующий проход. Журнал не даёт нескольким экземплярам слать одно и то же
+    ready = [(city, user_id) for city, user_ids in groups.items() if forecasts[city] is not None
+             for user_id in user_ids]
+    chunk = max(1, int(BROADCAST_LEASE * sender.rate * LEASE_SHARE))
+
+    # следующая порция берётся, когда предыдущая разослана, — аренда не истекает,
+    # пока сообщения ещё стоят в очереди
+    for start in range(0, len(ready), chunk):
+        part = ready[start:start + chunk]
+        claimed = set(await claim_broadcast([user_id for _, user_id in part], day, BROADCAST_LEASE))
+
+        deliveries = []
+        for city, user_ids in group_by_city((user_id, city) for city, user_id in part).items():
+            user_ids = [user_id for user_id in user_ids if user_id in claimed]
+            if user_ids:
+                text = f"📨 Ежедневная рассылка:\n\n{forecasts[city]}"
+                deliveries.append(_deliver_group(sender, user_ids, text, day))
+
+        BROADCAST_RECIPIENTS.inc(len(claimed))
+        await asyncio.gather(*deliveries)
+
+
+async def _deliver_group(sender: MessageSender, user_ids: list[int], text: str, day: str):
+    results = await asyncio.gather(*(sender.send(user_id, text) for user_id in user_ids))
+
+    # None — временная ошибка: аренду снимаем, чтобы повторить;
+    # False — доставить нельзя вовсе, повторять незачем
+    done = [user_id for user_id, result in zip(user_ids, results) if result is not None]
+    failed = [user_id for user_id, result in zip(user_ids, results) if result is None]
+
+    if done:
+        await confirm_broadcast(done, day)
+    if failed:
+        await release_broadcast(failed, day)
+
+
+async def prefetch(start: datetime, shard: int = 0, shards: int = 1, use_index: bool = True):
+    """Прогревает кэш прогнозов для городов из ближайших PREFETCH_MINUTES рассылок."""
+    slots = [start + timedelta(minutes=i) for i in range(1, PREFETCH_MINUTES + 1)]
+    if use_index:
+        slots = [slot for slot in slots if subscriptions.due(slot.hour * 60 + slot.minute)]
+    if not slots:
+        return
+
+    cities = await get_upcoming_cities([slot.strftime("%H:%M") for slot in slots], shard, shards)
+
+    # геокодинг почти всегда из кэша, но новые города не должны создавать всплеск
+    bucket = TokenBucket(PREFETCH_GEOCODING_RATE)
+
+    async def coords_of(city):
+        await bucket.acquire()
+        return await get_coords(city)
+
+    coords = await asyncio.gather(*(coords_of(city) for city in cities), return_exceptions=True)
+    coords = [c for c in coords if isinstance(c, tuple) and c[0] is not None]
+
+    # прогноз должен дожить до последней из рассылок окна
+    min_ttl = (slots[-1] - datetime.now()).total_seconds() + 60
+    try:
+        await load_forecasts(coords, min_ttl=min_ttl)
+    except Exception:
+        logger.exception("Не удалось предзагрузить прогнозы")
+
+
+async def scheduler(bot: Bot, shard: int = 0, shards: int = 1,
+                    use_index: bool = True, rate: float | None = None):
+    """Ежедневная рассылка погоды
+
+    В процессе бота минуты без подписчиков пропускаются по индексу в памяти.
+    Отдельные воркеры (use_index=False) не видят изменений из обработчиков
+    и каждую минуту спрашивают базу — по индексу subscriptions(time).
+    """
+    if use_index:
+        subscriptions.load(await get_all_subscriptions())
+
+    sender = MessageSender(bot) if rate is None else MessageSender(bot, rate=rate)
+    sender.start()
+
+    last = current_minute() - timedelta(minutes=1)
+    purged_day = None
+    prefetch_task = None
+
+    while True:
+        current = current_minute()
+
+        # ошибка одной минуты (например, «database is locked») не должна
+        # останавливать рассылку до перезапуска
+        try:
+            if current.date() != purged_day:
+                await purge_broadcast_log((current.date() - timedelta(days=1)).isoformat())
+                purged_day = current.date()
+
+            # предзагрузка идёт в фоне и не задерживает рассылку
+            if prefetch_task is None or prefetch_task.done():
+                prefetch_task = asyncio.create_task(prefetch(current, shard, shards, use_index))
+
+            # обрабатываем все минуты с прошлого прохода, включая пропущенные
+            last = max(last, current - timedelta(minutes=MAX_CATCH_UP))
+            while last < current:
+                slot = last + timedelta(minutes=1)
+                if not use_index or any(subscriptions.due(m.hour * 60 + m.minute) for m in retry_window(slot)):
+                    await broadcast(sender, slot, shard, shards)
+                last = slot
+        except Exception:
+            logger.exception("Ошибка планировщика рассылки")
+
+        # спим до начала следующей минуты
+        await asyncio.sleep(60 - time.time() % 60 + 0.05)
@@ -0,0 +1,142 @@
+import asyncio
+import random
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramForbiddenError, TelegramNetworkError,
+    TelegramRetryAfter, TelegramServerError
+)
+
+from database import mark_blocked
+from metrics import MESSAGES_SENT, SEND_FAILURES, SEND_RETRIES, SEND_QUEUE
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду на чат
+WORKERS = 8
+GLOBAL_RATE = 30
+PER_CHAT_INTERVAL = 1.0
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """Ограничитель частоты «ведро с токенами»."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class MessageSender:
+    """Очередь исходящих сообщений с пулом воркеров и контролем флуда."""
+
+    def __init__(self, bot: Bot, workers: int = WORKERS, rate: float = GLOBAL_RATE,
+                 per_chat_interval: float = PER_CHAT_INTERVAL):
+        self.bot = bot
+        self.workers = workers
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self._bucket = TokenBucket(rate)
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._chat_next: dict[int, float] = {}
+        self._paused_until = 0.0
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def send(self, chat_id: int, text: str, **kwargs) -> asyncio.Future:
+        """Ставит сообщение в очередь.
+
+        Future завершится True — доставлено, False — доставить нельзя (бот
+        заблокирован, ошибка запроса), None — не вышло сейчас, можно повторить позже.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((chat_id, text, kwargs, future))
+        SEND_QUEUE.set(self._queue.qsize())
+        return future
+
+    async def _wait_turn(self, chat_id: int):
+        # общая пауза после flood control
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # не чаще раза в per_chat_interval в один чат
+        now = time.monotonic()
+        ready = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, ready) + self.per_chat_interval
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+        await self._bucket.acquire()
+
+        if len(self._chat_next) > 10_000:
+            now = time.monotonic()
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+
+    async def _deliver(self, chat_id: int, text: str, kwargs: dict) -> bool | None:
+        for attempt in range(MAX_RETRIES):
+            await self._wait_turn(chat_id)
+
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                MESSAGES_SENT.inc()
+                return True
+
+            except TelegramRetryAfter as e:
+                SEND_RETRIES.inc(reason="retry_after")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+
+            except TelegramForbiddenError:
+                # пользователь заблокировал бота — больше ему не пишем
+                SEND_FAILURES.inc(reason="blocked")
+                await mark_blocked(chat_id)
+                return False
+
+            except (TelegramNetworkError, TelegramServerError):
+                SEND_RETRIES.inc(reason="network")
+                await asyncio.sleep(min(2 ** attempt, 30) + random.random())
+
+            except TelegramAPIError:
+                SEND_FAILURES.inc(reason="api_error")
+                return False
+
+        SEND_FAILURES.inc(reason="retries_exhausted")
+        return None
+
+    async def _worker(self):
+        while True:
+            chat_id, text, kwargs, future = await self._queue.get()
+            try:
+                result = await self._deliver(chat_id, text, kwargs)
+            except Exception:
+                result = None
+            finally:
+                self._queue.task_done()
+                SEND_QUEUE.set(self._queue.qsize())
+
+            if not future.done():
+                future.set_result(result)
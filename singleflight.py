@@ -0,0 +1,29 @@
+import asyncio
+
+
+class SingleFlight:
+    """Объединение одновременных запросов с одинаковым ключом.
+
+    Пока запрос по ключу выполняется, остальные вызовы ждут его результат,
+    а не отправляют свой.
+    """
+
+    def __init__(self):
+        self._calls: dict = {}
+
+    async def do(self, key, func, *args):
+        task = self._calls.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(func(*args))
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+
+        # отмена одного ожидающего не должна отменять общий запрос
+        return await asyncio.shield(task)
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message
+
+from cache import TTLCache, MISSING
+from metrics import THROTTLED
+
+# Пользователь: в среднем USER_RATE апдейтов в секунду, подряд — до USER_BURST
+USER_RATE = 1.0
+USER_BURST = 5
+
+# Повтор того же нажатия тем же пользователем в течение DEBOUNCE секунд пропускаем
+DEBOUNCE = 1.0
+
+# Обработчики с флагом heavy (ходят в Open-Meteo) выполняются не больше
+# HEAVY_CONCURRENCY одновременно; кто не дождался места за HEAVY_WAIT секунд — отказ
+HEAVY_CONCURRENCY = 50
+HEAVY_WAIT = 5.0
+
+# Состояния пользователей храним в LRU — активных обычно немного
+MAX_USERS = 100_000
+
+SLOW_DOWN_TEXT = "⏳ Слишком часто, подождите немного."
+BUSY_TEXT = "⏳ Бот сейчас перегружен, попробуйте через минуту."
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Защита от флуда: лимит на пользователя, отсев повторных нажатий
+    и общий лимит одновременных «тяжёлых» обработчиков.
+
+    Отклонённый апдейт получает дешёвый ответ без обращения к Open-Meteo:
+    всплывающее уведомление на кнопку или одно предупреждение на сообщения.
+    """
+
+    def __init__(self, rate: float = USER_RATE, burst: float = USER_BURST,
+                 debounce: float = DEBOUNCE, heavy_concurrency: int = HEAVY_CONCURRENCY):
+        self.rate = rate
+        self.burst = burst
+        # user_id → [токены, время обновления, предупреждён ли]
+        self._buckets = TTLCache(maxsize=MAX_USERS, ttl=burst / rate)
+        self._recent = TTLCache(maxsize=MAX_USERS, ttl=debounce)
+        self._heavy = asyncio.Semaphore(heavy_concurrency)
+
+    def _allow(self, user_id: int) -> tuple[bool, bool]:
+        """(пропустить ли апдейт, нужно ли предупредить пользователя)."""
+        now = time.monotonic()
+        state = self._buckets.get(user_id)
+        if state is MISSING:
+            state = [self.burst, now, False]
+
+        state[0] = min(self.burst, state[0] + (now - state[1]) * self.rate)
+        state[1] = now
+        self._buckets.set(user_id, state)
+
+        if state[0] >= 1:
+            state[0] -= 1
+            state[2] = False
+            return True, False
+
+        warn = not state[2]
+        state[2] = True
+        return False, warn
+
+    async def _reject(self, event, text: str, reason: str, warn: bool = True):
+        THROTTLED.inc(reason=reason)
+
+        if isinstance(event, CallbackQuery):
+            await event.answer(text if warn else None)
+        elif isinstance(event, Message) and warn:
+            await event.answer(text)
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery):
+            key = (user.id, event.data)
+            if self._recent.get(key) is not MISSING:
+                # повторное нажатие — только убираем «часики»
+                return await self._reject(event, "", "debounce", warn=False)
+            self._recent.set(key, True)
+
+        allowed, warn = self._allow(user.id)
+        if not allowed:
+            return await self._reject(event, SLOW_DOWN_TEXT, "user_rate", warn)
+
+        if not get_flag(data, "heavy"):
+            return await handler(event, data)
+
+        try:
+            await asyncio.wait_for(self._heavy.acquire(), HEAVY_WAIT)
+        except asyncio.TimeoutError:
+            return await self._reject(event, BUSY_TEXT, "busy")
+
+        try:
+            return await handler(event, data)
+        finally:
+            self._heavy.release()
@@ -0,0 +1,178 @@
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+# Трассировки пишутся в этот логгер по одной JSON-строке на апдейт
+logger = logging.getLogger("trace")
+
+# Апдейт дольше SLOW_UPDATE секунд считается медленным
+SLOW_UPDATE = 2.0
+
+# Больше спанов в одной трассировке не записываем
+MAX_SPANS = 200
+
+_current: ContextVar["Trace | None"] = ContextVar("trace", default=None)
+_profiling = False
+
+
+class Trace:
+    """Этапы обработки одного апдейта: спаны (имя, начало, длительность, атрибуты)."""
+
+    __slots__ = ("update_id", "attrs", "started", "spans")
+
+    def __init__(self, update_id: int):
+        self.update_id = update_id
+        self.attrs = {}
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def as_dict(self, duration: float) -> dict:
+        return {
+            "update_id": self.update_id,
+            **self.attrs,
+            "duration_ms": round(duration * 1000, 2),
+            "spans": [
+                {"name": name, "start_ms": round(start * 1000, 2), "duration_ms": round(took * 1000, 2), **attrs}
+                for name, start, took, attrs in self.spans
+            ],
+        }
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Замер этапа (запрос к SQLite, Open-Meteo, Bot API, рендер) в текущей трассировке.
+
+    Вне трассировки ничего не делает.
+    """
+    trace = _current.get()
+    if trace is None or len(trace.spans) >= MAX_SPANS:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((name, start - trace.started, time.perf_counter() - start, attrs))
+
+
+def annotate(**attrs):
+    """Дополнительные поля текущей трассировки (например, имя обработчика)."""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+
+def _log(level: int, record: dict):
+    logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+
+
+def await_chain(task: asyncio.Task) -> list[str]:
+    """Цепочка await задачи от внешней корутины до места, где она сейчас ждёт."""
+    chain = []
+    coro = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        chain.append(f"{frame.f_code.co_filename}:{frame.f_lineno} in {frame.f_code.co_name}")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return chain
+
+
+def _dump_stack(trace: Trace, task: asyncio.Task, slow: float):
+    # апдейт ещё обрабатывается — записываем, где он ждёт
+    _log(logging.WARNING, {
+        "update_id": trace.update_id,
+        **trace.attrs,
+        "slow_after_s": slow,
+        "stack": await_chain(task),
+    })
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Трассировка каждого апдейта (внешний middleware на update).
+
+    slow — через сколько секунд записать стек ещё не завершённого апдейта.
+    profile_dir и profile_sample — профилировать cProfile долю апдейтов
+    и сохранять профиль медленных в profile_dir. Профилировщик один на поток,
+    поэтому в профиль попадают и апдейты, обрабатывавшиеся параллельно.
+    """
+
+    def __init__(self, slow: float | None = SLOW_UPDATE, profile_dir: str | None = None,
+                 profile_sample: float = 0.0):
+        self.slow = slow
+        self.profile_dir = profile_dir
+        self.profile_sample = profile_sample
+
+    def _start_profiler(self) -> cProfile.Profile | None:
+        global _profiling
+
+        if not self.profile_dir or _profiling or random.random() >= self.profile_sample:
+            return None
+
+        _profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _finish_profiler(self, profiler: cProfile.Profile, trace: Trace, duration: float):
+        global _profiling
+
+        profiler.disable()
+        _profiling = False
+
+        if self.slow is not None and duration >= self.slow:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"update-{trace.update_id}.prof")
+            profiler.dump_stats(path)
+            trace.attrs["profile"] = path
+
+    async def __call__(self, handler, event, data):
+        trace = Trace(event.update_id)
+        trace.attrs["type"] = event.event_type
+        user = data.get("event_from_user")
+        if user is not None:
+            trace.attrs["user_id"] = user.id
+        token = _current.set(trace)
+
+        watchdog = None
+        if self.slow is not None:
+            watchdog = asyncio.get_running_loop().call_later(
+                self.slow, _dump_stack, trace, asyncio.current_task(), self.slow
+            )
+        profiler = self._start_profiler()
+
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            trace.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - trace.started
+            _current.reset(token)
+
+            if watchdog is not None:
+                watchdog.cancel()
+            if profiler is not None:
+                self._finish_profiler(profiler, trace, duration)
+
+            slow = self.slow is not None and duration >= self.slow
+            _log(logging.WARNING if slow else logging.INFO, trace.as_dict(duration))
+
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """Спан на каждый запрос к Bot API (отправка, редактирование, ответ на кнопку)."""
+
+    async def __call__(self, make_request, bot, method):
+        with span("telegram", method=type(method).__name__):
+            return await make_request(bot, method)
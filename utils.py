@@ -0,0 +1,3 @@
+def normalize_city(city: str) -> str:
+    """Ключ города: нижний регистр, схлопнутые пробелы, ё → е."""
+    return " ".join(city.lower().replace("ё", "е").split())
@@ -1,4 +1,5 @@
-import requests
+from geocoding import get_coords
+from forecast_api import load_forecast, render_cached
 
 WEATHER_CODES = {
     0: "☀ Ясно",
@@ -41,32 +42,21 @@ WEATHER_CODES = {
     99: "⛈ Сильная гроза с градом",
 }
 
-def get_weather(city: str):
+async def get_weather(city: str):
     """Текущая погода — исправленная, реальная, без завышений"""
 
-    # Геокодинг
-    geo = requests.get(
-        f"https://geocoding-api.open-meteo.com/v1/search?name={city}&count=1&language=ru"
-    ).json()
-
-    if "results" not in geo:
+    # Геокодинг (с кэшем)
+    lat, lon = await get_coords(city)
+    if lat is None:
         return "❌ Город не найден."
 
-    lat = geo["results"][0]["latitude"]
-    lon = geo["results"][0]["longitude"]
-
-    # ТЕКУЩАЯ ПОГОДА (current_weather)
-    url = (
-        f"https://api.open-meteo.com/v1/forecast?"
-        f"latitude={lat}&longitude={lon}"
-        f"&current_weather=true"
-        f"&timezone=auto"
-    )
+    # ТЕКУЩАЯ ПОГОДА (current_weather) — из общего с прогнозами кэша
+    forecast = await load_forecast(lat, lon)
 
-    data = requests.get(url).json()
+    return render_cached((city, "now", None, forecast.version), render_current, city, forecast.current)
 
-    w = data["current_weather"]
 
+def render_current(city: str, w: dict) -> str:
     temp = w["temperature"]
     wind = w["windspeed"]
     code = w["weathercode"]
@@ -0,0 +1,130 @@
+import asyncio
+import hmac
+import logging
+import re
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+import config
+
+# Настройки webhook-режима (config.py); без WEBHOOK_URL бот работает через polling.
+# WEBHOOK_URL — внешний адрес бота, например https://bot.example.com
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+WEBHOOK_PATH = getattr(config, "WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getattr(config, "WEBHOOK_SECRET", None)
+WEBHOOK_HOST = getattr(config, "WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8080)
+
+# Ограничение параллельной обработки апдейтов
+UPDATE_WORKERS = getattr(config, "UPDATE_WORKERS", 32)
+UPDATE_QUEUE_SIZE = getattr(config, "UPDATE_QUEUE_SIZE", 1000)
+
+# При остановке столько секунд дообрабатываем уже принятые апдейты:
+# на них ответили 200, и Telegram их повторно не пришлёт
+DRAIN_TIMEOUT = getattr(config, "DRAIN_TIMEOUT", 30)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Допустимый секрет по документации Bot API
+SECRET_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,256}")
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_enabled() -> bool:
+    return bool(WEBHOOK_URL)
+
+
+class UpdateQueue:
+    """Очередь входящих апдейтов с фиксированным числом обработчиков."""
+
+    def __init__(self, bot: Bot, dp: Dispatcher,
+                 workers: int = UPDATE_WORKERS, maxsize: int = UPDATE_QUEUE_SIZE):
+        self.bot = bot
+        self.dp = dp
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Остановка: в очереди осталось апдейтов — %d", self._queue.qsize())
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, update: dict) -> bool:
+        try:
+            self._queue.put_nowait(update)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception:
+                logger.exception("Ошибка обработки апдейта")
+            finally:
+                self._queue.task_done()
+
+
+def create_app(bot: Bot, updates: UpdateQueue) -> web.Application:
+    async def handle(request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, WEBHOOK_SECRET):
+            return web.Response(status=401)
+
+        update = await request.json(loads=bot.session.json_loads)
+
+        # очередь переполнена — Telegram повторит доставку позже
+        if not updates.put(update):
+            return web.Response(status=503)
+
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle)
+    return app
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Приём апдейтов через локальный aiohttp-сервер."""
+    # без секрета любой, кто узнал адрес, смог бы подсовывать апдейты;
+    # задаётся в config.py, чтобы совпадать у всех экземпляров
+    if not WEBHOOK_SECRET or not SECRET_PATTERN.fullmatch(WEBHOOK_SECRET):
+        raise RuntimeError(
+            "Для webhook задайте в config.py WEBHOOK_SECRET: 1–256 символов A-Z, a-z, 0-9, _ и -"
+        )
+
+    updates = UpdateQueue(bot, dp)
+    updates.start()
+
+    runner = web.AppRunner(create_app(bot, updates))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+    # несколько экземпляров за балансировщиком регистрируют один и тот же URL,
+    # поэтому при остановке webhook не удаляем
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        # сначала перестаём принимать апдейты, затем дообрабатываем очередь
+        await runner.cleanup()
+        await updates.stop()
@@ -0,0 +1,90 @@
+"""Отдельные процессы ежедневной рассылки.
+
+    python worker.py --processes 4            # 4 процесса на этой машине
+    python worker.py --shard 1 --shards 4     # одна доля из четырёх
+
+Подписчики делятся между воркерами по user_id % shards. Журнал рассылки
+в базе (аренда записи до подтверждения доставки) гарантирует, что каждый
+получит прогноз один раз в день, даже если часть долей запущена на нескольких
+экземплярах, а недоставленное будет повторено. Чтобы бот не рассылал сам,
+задайте в config.py RUN_SCHEDULER = False.
+"""
+import argparse
+import asyncio
+import multiprocessing
+
+from aiogram import Bot
+from aiogram.client.default import DefaultBotProperties
+
+import config
+from config import TOKEN
+from database import init_db, close_db
+from http_client import close_session
+from metrics import start_metrics_server
+from scheduler import scheduler
+from sender import GLOBAL_RATE
+
+# Метрики воркера — на порту METRICS_PORT + 1 + номер доли
+METRICS_HOST = getattr(config, "METRICS_HOST", "127.0.0.1")
+METRICS_PORT = getattr(config, "METRICS_PORT", 9090)
+
+
+async def run_shard(shard: int, shards: int):
+    bot = Bot(
+        token=TOKEN,
+        default=DefaultBotProperties(parse_mode="Markdown")
+    )
+
+    port = METRICS_PORT + 1 + shard if METRICS_PORT is not None else None
+    metrics_runner = await start_metrics_server(METRICS_HOST, port)
+
+    # лимит Telegram общий на бота — делим его между долями
+    try:
+        await scheduler(bot, shard, shards, use_index=False, rate=GLOBAL_RATE / shards)
+    finally:
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        await close_session()
+        close_db()
+
+
+def start_shard(shard: int, shards: int):
+    asyncio.run(run_shard(shard, shards))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркеры ежедневной рассылки")
+    parser.add_argument("--processes", type=int, default=1, help="сколько долей запустить локально")
+    parser.add_argument("--shard", type=int, help="номер одной доли (вместе с --shards)")
+    parser.add_argument("--shards", type=int, help="общее число долей")
+    args = parser.parse_args()
+
+    # без --shards доля N ≥ 1 не совпала бы ни с одним user_id — воркер молча простаивал бы
+    if (args.shard is None) != (args.shards is None):
+        parser.error("--shard и --shards задаются вместе")
+    if args.shard is not None and not 0 <= args.shard < args.shards:
+        parser.error("--shard должен быть от 0 до --shards - 1")
+    if args.processes < 1:
+        parser.error("--processes должно быть не меньше 1")
+
+    # миграции — один раз до запуска процессов
+    init_db()
+    close_db()
+
+    if args.shard is not None:
+        start_shard(args.shard, args.shards)
+        return
+
+    processes = [
+        multiprocessing.Process(target=start_shard, args=(shard, args.processes))
+        for shard in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()